@@ -0,0 +1,265 @@
+"""
+Mia Skinner
+Heather Koo
+CIS41B Final project
+dataAccess.py:
+- the one place that opens SQLite connections for Shipments.db and Forecast.db.
+- database paths are configurable with setPath or the SHIPMENTS_DB / FORECAST_DB environment variables,
+  and the directory of the saved plot snapshots with SNAPSHOT_DIR.
+- the memory ceiling of the product data, for shipment histories larger than RAM, is configurable
+  with setMemoryLimit or the SHIPMENTS_MEMORY_MB environment variable.
+- Shipments.db may be split into shard files by product (see shipmentsDB.ingestShards); queryShipments
+  routes a query to every shard, or to Shipments.db when there are no shards.
+- readers share a pool of read-only connections, one per thread and database, that stay open between uses,
+  so connection setup and statement parsing of the hot queries happen once per thread.
+"""
+
+import os
+import re
+import pathlib
+import glob
+import itertools
+import sqlite3
+import threading
+import atexit
+
+SHIPMENTS = 'shipments'
+FORECAST = 'forecast'
+SNAPSHOTS = 'snapshots'         # directory of the pickled plot snapshots of saved forecasts
+SHARD = SHIPMENTS + ':{}'       # database name of a shipment shard, e.g. 'shipments:3'
+
+_paths = {SHIPMENTS: os.environ.get('SHIPMENTS_DB', 'Shipments.db'),
+          FORECAST: os.environ.get('FORECAST_DB', 'Forecast.db'),
+          SNAPSHOTS: os.environ.get('SNAPSHOT_DIR', '.')}
+_memoryLimitMB = os.environ.get('SHIPMENTS_MEMORY_MB') or None
+
+BUSY_TIMEOUT = 30                   # seconds a connection waits for another connection's lock.
+STATEMENT_CACHE_SIZE = 256          # compiled statements kept per connection.
+MMAP_SIZE = 256 * 1024 * 1024       # bytes of the database file read through memory mapping.
+CACHE_SIZE_KB = 64 * 1024           # page cache per connection.
+
+# hot queries. sqlite3 keeps the compiled statement of each distinct SQL string in the connection's
+# statement cache, so always executing these exact strings on a pooled connection parses them only once.
+SELECT_SHIPMENTS = '''SELECT mkt_item_wid, cust_ship_date, quantity FROM Shipments '''
+# sentinel (2050) ship dates are quarantined at ingest, but a Shipments.db built before validation (see isLegacy)
+# still holds them; its reads filter them out of the series until the database is rebuilt.
+LEGACY_FILTER = "WHERE substr(cust_ship_date, 1, 4) < '2050' "
+SELECT_LEGACY_SHIPMENTS = SELECT_SHIPMENTS + LEGACY_FILTER
+INSERT_SHIPMENT = '''INSERT INTO Shipments
+                     (csd_date_wid, date_wid, customer_wid, mkt_item_wid, cust_ship_date, order_number, quantity)
+                      VALUES (?, ?, ?, ?, ?, ?, ?)'''
+SELECT_PRODUCT_STATS = '''SELECT mkt_item_wid, nonzero_months, first_active, last_active, total_volume
+                          FROM ProductStats ORDER BY nonzero_months'''
+INSERT_QUARANTINE = '''INSERT INTO Quarantine (source, reason, record) VALUES (?, ?, ?)'''
+SELECT_LIVE_FORECASTS = '''SELECT productID, forecastRun, period, expirationDate, quantity, accuracy, p10, p90
+                           FROM Forecast WHERE expirationDate > ? '''
+INSERT_FORECAST = '''INSERT INTO Forecast
+                     (productID, forecastRun, period, expirationDate, quantity, accuracy, p10, p50, p90)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+INSERT_FORECAST_SERIES = '''INSERT INTO ForecastSeries
+                            (productID, forecastRun, month, quantity, p10, p50, p90)
+                             VALUES (?, ?, ?, ?, ?, ?, ?)'''
+SELECT_MODELS = '''SELECT productID, firstYear, degree, scale, n, updates, needsRefit,
+                          powerSums, moments, stepErrors, maxR2, metrics
+                   FROM IncrementalModel'''
+REPLACE_MODEL = '''INSERT OR REPLACE INTO IncrementalModel
+                   (productID, firstYear, degree, scale, n, updates, needsRefit,
+                    powerSums, moments, stepErrors, maxR2, metrics)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+# every saved forecast with its forecast months, in save order. A forecast saved before ForecastSeries existed
+# has no months: it gets one row with an empty month and the quantity and band of its summary.
+SELECT_FORECAST_EXPORT = '''SELECT f.id, f.productID, f.forecastRun, f.period, f.expirationDate, f.accuracy,
+                                   s.month, COALESCE(s.quantity, f.quantity), COALESCE(s.p10, f.p10),
+                                   COALESCE(s.p50, f.p50), COALESCE(s.p90, f.p90)
+                            FROM Forecast f LEFT JOIN ForecastSeries s
+                                 ON s.productID = f.productID AND s.forecastRun = f.forecastRun
+                            ORDER BY f.id, s.month'''
+
+
+def getPath(dbName):
+    """
+    returns the file path of a database.
+    :param dbName: SHIPMENTS, FORECAST or a shard name SHARD.format(i)
+    :return: the file path
+    """
+    if dbName.startswith(SHIPMENTS + ':'):
+        return shardPath(int(dbName.split(':')[1]))
+    return _paths[dbName]
+
+
+def snapshotPath(productID, forecastRun):
+    """
+    returns the file path of the pickled plot snapshot of a saved forecast.
+    :param productID: the product of the forecast
+    :param forecastRun: the date the forecast was saved, YYYY-MM-DD
+    :return: the file path
+    """
+    return os.path.join(_paths[SNAPSHOTS], '{}_{}.bin'.format(productID, forecastRun))
+
+
+def shardPath(i, shipmentsPath=None):
+    """
+    returns the file path of a shipment shard, next to Shipments.db, e.g. Shipments_shard3.db.
+    :param i: the shard number
+    :param shipmentsPath: the Shipments.db path the shard belongs to, the configured one by default
+    :return: the file path
+    """
+    root, ext = os.path.splitext(shipmentsPath or _paths[SHIPMENTS])
+    return '{}_shard{}{}'.format(root, i, ext)
+
+
+def shardNames():
+    """
+    returns the database names of the shipment shards that exist on disk, in shard order.
+    :return: a list of SHARD names, empty when Shipments.db is not sharded
+    """
+    root, ext = os.path.splitext(_paths[SHIPMENTS])
+    pattern = re.compile(re.escape(root + '_shard') + r'(\d+)' + re.escape(ext) + '$')
+    numbers = []
+    for path in glob.glob(shardPath('*')):
+        match = pattern.match(path)
+        if match:
+            numbers.append(int(match.group(1)))
+    return [SHARD.format(i) for i in sorted(numbers)]
+
+
+def shipmentsNames():
+    """
+    returns the database names that hold the shipment data: the shards if there are any, else Shipments.db.
+    :return: a list of database names
+    """
+    return shardNames() or [SHIPMENTS]
+
+
+def setPath(dbName, path):
+    """
+    changes the file path of a database. Pooled connections to the old path are closed.
+    :param dbName: SHIPMENTS or FORECAST
+    :param path: the new file path
+    :return: None
+    """
+    closeAll()
+    _paths[dbName] = path
+
+
+def getMemoryLimit():
+    """
+    returns the memory ceiling of the product data read by PlotOrder (see shipmentAggregation.py).
+    :return: the ceiling in megabytes, or None to read all product data into memory
+    """
+    return None if _memoryLimitMB is None else int(_memoryLimitMB)
+
+
+def setMemoryLimit(memoryLimitMB):
+    """
+    changes the memory ceiling of the product data read by PlotOrder.
+    :param memoryLimitMB: the ceiling in megabytes, or None to read all product data into memory
+    :return: None
+    """
+    global _memoryLimitMB
+    _memoryLimitMB = memoryLimitMB
+
+
+def readOnlyURI(path):
+    """
+    returns the URI that opens a database file read-only, with the characters of the path
+    that have a meaning in URIs (?, #, %) quoted.
+    :param path: the file path
+    :return: a file: URI
+    """
+    return pathlib.Path(path).absolute().as_uri() + '?mode=ro'
+
+
+def connect(dbName, readOnly=False):
+    """
+    opens a new tuned connection to a database. The caller owns and closes it.
+    :param dbName: SHIPMENTS, FORECAST or a shard name
+    :param readOnly: True to open the file through a read-only URI.
+                     Read-only connections may be closed from another thread, which closeAll relies on.
+    :return: a sqlite3 connection
+    """
+    path = getPath(dbName)
+    if readOnly:
+        conn = sqlite3.connect(readOnlyURI(path), uri=True, timeout=BUSY_TIMEOUT,
+                               cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE)
+    conn.execute('PRAGMA mmap_size={}'.format(MMAP_SIZE))
+    conn.execute('PRAGMA cache_size=-{}'.format(CACHE_SIZE_KB))
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+
+_local = threading.local()
+_pool = []                  # every pooled connection of every thread, to close them all on exit
+_poolLock = threading.Lock()
+
+
+def getConnection(dbName):
+    """
+    returns the pooled read-only connection of the calling thread for a database, opening it on first use.
+    Do not close it; it is reused by the next reader on the same thread.
+    :param dbName: SHIPMENTS or FORECAST
+    :return: a sqlite3 connection
+    """
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = dict()
+    conn = conns.get(dbName)
+    if conn is None:
+        conn = conns[dbName] = connect(dbName, readOnly=True)
+        with _poolLock:
+            _pool.append((conns, dbName, conn))
+    return conn
+
+
+def execute(dbName, sql, params=()):
+    """
+    runs a read query on the pooled connection of the calling thread.
+    :param dbName: SHIPMENTS or FORECAST
+    :param sql: the query, preferably one of the hot query constants
+    :param params: the query parameters
+    :return: a cursor over the result rows
+    """
+    return getConnection(dbName).execute(sql, params)
+
+
+def isLegacy(dbName):
+    """
+    tells whether a shipment database was built before ingest validation (it has no Quarantine table),
+    so its rows have not been normalized and may still have sentinel dates.
+    :param dbName: SHIPMENTS or a shard name
+    :return: True for a database that needs the legacy queries
+    """
+    sql = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Quarantine'"
+    return execute(dbName, sql).fetchone() is None
+
+
+def queryShipments(sql, params=(), dbNames=None, legacySql=None):
+    """
+    runs a read query on every shipment database and chains the result rows.
+    Each product lives in exactly one shard, so per-product results need no merging.
+    :param sql: the query, preferably one of the hot query constants
+    :param params: the query parameters
+    :param dbNames: the shipment databases to query, shipmentsNames() by default
+    :param legacySql: the query to run instead on a database built before ingest validation (see isLegacy)
+    :return: an iterator over the result rows
+    """
+    if dbNames is None:
+        dbNames = shipmentsNames()
+    return itertools.chain.from_iterable(
+        execute(dbName, legacySql if legacySql is not None and isLegacy(dbName) else sql, params)
+        for dbName in dbNames)
+
+
+@atexit.register
+def closeAll():
+    """
+    closes every pooled connection. Threads open a new one on their next read.
+    :return: None
+    """
+    with _poolLock:
+        for conns, dbName, conn in _pool:
+            conns.pop(dbName, None)
+            conn.close()
+        del _pool[:]
@@ -6,15 +6,18 @@ Mia Skinner
 CIS41B Final Project
 final_gui.py:
 - Creates a GUI window for the user to interact with the forecasting tool.
-- Uses Shipments.db (built by shipmentsDB.py) for input.
+- Uses Shipments.db (built by shipmentsDB.py) for input. For a shipment history larger than RAM, set
+  SHIPMENTS_MEMORY_MB to a memory ceiling; the product data is then kept within it and the peak RSS is printed.
 - Stores user's "saved" forecasts to .csv, .bin, and Forecast.db files
 """
-import sqlite3
+import dataAccess
 import tkinter as tk
 import matplotlib
 matplotlib.use('TkAgg')
 import matplotlib.pyplot as plt
-from final_visualization import PlotOrder
+from final_visualization import PlotOrder, MIN_DATA_PTS
+import forecastWriter
+import forecastRetention
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import tkinter.messagebox as tkmb
 import tkinter.filedialog
@@ -23,12 +26,21 @@ from dateutil.relativedelta import *
 import os
 import re
 import pickle
+import sqlite3
+import collections
+import csv
 
 
 OPTIONS = ["One Month Forecast",
            "One Quarter Forecast",
            "One Year Forecast"]
 
+# product picker sort choices: (ProductStats field or None for product ID, descending order)
+SORT_OPTIONS = collections.OrderedDict([("Product ID", (None, False)),
+                                        ("Active Months", ('nonZeroMonths', True)),
+                                        ("Total Volume", ('totalVolume', True)),
+                                        ("Last Active", ('lastActive', True))])
+
 
 class MainWin(tk.Tk):
     """ The main program window. The user can choose to view past saved forecasts (by clicking on listbox entries)
@@ -52,7 +64,7 @@ class MainWin(tk.Tk):
         self.F2 = tk.Frame(self)
         self.F2.grid(row=3, padx=10, pady=(0,10))
         S = tk.Scrollbar(self.F2)
-        self.LB = tk.Listbox(self.F2, height=15, width=50, yscrollcommand=S.set)
+        self.LB = tk.Listbox(self.F2, height=15, width=70, yscrollcommand=S.set)
         self.LB.bind('<ButtonRelease-1>', self._showSavedForecastChoice)
         S.config(command=self.LB.yview)
         self.LB.grid()
@@ -63,25 +75,29 @@ class MainWin(tk.Tk):
         L1 = tk.Label(self.F3, text="View Previous Selection:")
 
         #spaced to match approximate entry lengths
-        L2 = tk.Label(self.F3, text="Prod.   ForecastRun    Period            Expiration     Quantity   MAPE")
+        L2 = tk.Label(self.F3, text="Prod.   ForecastRun    Period            Expiration     Quantity   MAPE      P10       P90")
         self.F3.grid(row=1, sticky='w', padx=10)
         L1.grid(sticky='w')
         L2.grid()
 
         self._getData()
+        # archives expired forecasts and their snapshots in the background while the tool is open
+        forecastRetention.startBackground()
 
     def _getData(self):
         """
-        creates sqlite connection and cursor objects to connect to the database.
+        gets the pooled read-only sqlite connection and a cursor to read the saved forecasts.
         :return: None
         """
-        self.conn = sqlite3.connect('Forecast.db')
+        forecastWriter.prepare()
+        self.conn = dataAccess.getConnection(dataAccess.FORECAST)
         self.cur = self.conn.cursor()
-        self.cur.execute('''SELECT productID, forecastRun, period, expirationDate, quantity, accuracy FROM Forecast WHERE expirationDate > ? ''', (datetime.date.today(),))
+        self.cur.execute(dataAccess.SELECT_LIVE_FORECASTS, (datetime.date.today(),))
         for record in self.cur.fetchall():
             s = ""
             for item in record:
                 if isinstance(item, float): item = round(item, 2)
+                if item is None: item = "-"     # saved before prediction intervals were added
                 s = s + str(item) + "     "
             self.LB.insert(tk.END, s)
 
@@ -197,14 +213,15 @@ class DialogWin2(tk.Toplevel):
 
         self._controlVar = tk.StringVar()
         self.title("Product Order Forecast")
-        self.visualObj = PlotOrder()
+        memoryLimitMB = dataAccess.getMemoryLimit()
+        self.visualObj = PlotOrder(memoryLimitMB=memoryLimitMB, verbose=memoryLimitMB is not None)
 
         # set up empty graph area
         self.fig = plt.figure(figsize=(7, 7))
         self.canvas = FigureCanvasTkAgg(self.fig, master=self)
         self.canvas.get_tk_widget().grid(row=1, columnspan=2)
         self.canvas.draw()
-        self.conn = sqlite3.connect('Forecast.db')
+        self.writer = forecastWriter.getWriter()
 
         # supports both saved file custom forecast paths
         # coming from Custom Forecast window
@@ -215,14 +232,18 @@ class DialogWin2(tk.Toplevel):
                                                                         pady=10)
             self.x = None
             self.y = None
+            self.bands = None
             self.choice = None
             self.startDate = master._inputDate.get()
 
         # coming from Saved Forecast listbox
         if lbChoice:
             self.choice = lbChoice.split()
-            self.x, self.y, self.productID, self.m, self.listX, self.listY, self.newlabel, self.newpos = pickle.load(open("{}_{}.bin".format(self.choice[0], self.choice[1]), "rb"))
-            self.visualObj.savedForecastPlot(self.x, self.y, self.m, self.productID, self.listX, self.listY, self.newlabel, self.newpos)
+            saved = pickle.load(open(dataAccess.snapshotPath(self.choice[0], self.choice[1]), "rb"))
+            self.x, self.y, self.productID, self.m, self.listX, self.listY, self.newlabel, self.newpos = saved[:8]
+            # forecasts saved before prediction intervals were added have no bands
+            self.bands = saved[8] if len(saved) > 8 else None
+            self.visualObj.savedForecastPlot(self.x, self.y, self.m, self.productID, self.listX, self.listY, self.newlabel, self.newpos, self.bands)
             self.canvas.get_tk_widget().grid(row=1, columnspan=2)
             self.canvas.draw()
 
@@ -245,7 +266,7 @@ class DialogWin2(tk.Toplevel):
         :return: None
         """
         productGen = self.visualObj.findAvaliableProducts()
-        self.dialog = DialogWin3(self, sorted(productGen))
+        self.dialog = DialogWin3(self, sorted(productGen), self.visualObj.productStats)
         self.wait_window(self.dialog)
         self._displayChart(self.choice)
 
@@ -261,7 +282,7 @@ class DialogWin2(tk.Toplevel):
         # 2 = One Year Forecast
         for durIndex in range(len(OPTIONS)):
             if self.durationChoice == OPTIONS[durIndex]:
-                self.x, self.y, self.m, self.listX, self.listY, self.newlabel, self.newpos = \
+                self.x, self.y, self.m, self.listX, self.listY, self.newlabel, self.newpos, self.bands = \
                     self.visualObj.forecastPlot(var, durIndex, int(self.startDate[0:4]), int(self.startDate[5:7]))
 
         self.canvas.get_tk_widget().grid(row=1, columnspan=2)
@@ -269,40 +290,62 @@ class DialogWin2(tk.Toplevel):
 
     def writeToDB(self):
         """
-        Writes current plot summary to Forecast.db database to save for main window listbox entries
+        Writes current plot summary to Forecast.db database to save for main window listbox entries,
+        and every forecast month to the ForecastSeries table for the bulk export.
+        The rows go through the shared writer queue as one group, so they are saved together or not at all,
+        and are committed before returning.
         :return: none
         """
-        self.cur = self.conn.cursor()
-        self.cur.execute('''INSERT INTO Forecast
-                           (productID, forecastRun, period, expirationDate, quantity, accuracy)
-                            VALUES (?, ?, ?, ?, ?, ?)''', (self.choice,
-                                                           str(datetime.date.today()),
-                                                           self.durationChoice[:-9],
-                                                           str(datetime.date.today() + relativedelta(months=+1)),
-                                                           self.y[-1][0],
-                                                           self.visualObj.getMae()*100))
+        summary = (self.choice,
+                   str(datetime.date.today()),
+                   self.durationChoice[:-9],
+                   str(datetime.date.today() + relativedelta(months=+1)),
+                   self.listY[-1],     # the last forecast month, which the band below belongs to
+                   self.visualObj.getMae()*100,
+                   *self.bands[-1])
+        self.writer.writeGroup([(dataAccess.INSERT_FORECAST_SERIES, row) for row in self._forecastMonths()] +
+                               [(dataAccess.INSERT_FORECAST, summary)])
+        self.writer.flush()
+
 
+    def _forecastMonths(self):
+        """
+        a generator of the ForecastSeries rows of the forecast in view, one per forecast month.
+        The first forecast month is the month after the start date.
+        :return: None
+        """
+        start = datetime.date(int(self.startDate[0:4]), int(self.startDate[5:7]), 1)
+        for i, (quantity, band) in enumerate(zip(self.listY[-self.m:], self.bands)):
+            month = start + relativedelta(months=+(i + 1))
+            yield (self.choice, str(datetime.date.today()), month.strftime('%Y-%m'), quantity, *band)
 
     def _save(self):
         """
         Override 'X' button to:
          - save plot variables to pickle file to be able to view the plot again in a different session.
          - write plot summary entry to Forecast.db.
-         - save the forecast plot for the product in view to a .csv file to a location of the user's choice.
+         - save the fitted curve and the forecast months with their P10/P50/P90 band for the product in view
+           to a .csv file to a location of the user's choice.
         :return: None
         """
         if self.x is not None and self.y is not None:
-            self.writeToDB()
+            try:
+                self.writeToDB()
+            except (sqlite3.DatabaseError, OSError) as e:
+                tkmb.showerror("Save", "The forecast could not be saved to the database: {}".format(e), parent=self)
+                return
             self.writeToPickle()
 
             if tkmb.askokcancel("Save", "Where would you like to save the forecast results for product {}?".format(self.choice), parent=self):
                 directory = tk.filedialog.askdirectory(initialdir=".")
                 if directory:
                     outputFilename = "forecast_{}_{}.csv".format(str(self.choice),datetime.date.today())
-                    with open(os.path.join(directory, outputFilename), 'w') as fh:
-                        fh.write("x,y\n") # header
-                        for line in range(len(self.x)):
-                            fh.write(str(*self.x[line]) + "," + str(*self.y[line]) + "\n")
+                    with open(os.path.join(directory, outputFilename), 'w', newline='') as fh:
+                        writer = csv.writer(fh)
+                        writer.writerow(["x", "y", "p10", "p50", "p90"])   # header
+                        writer.writerows((x[0], y[0], "", "", "") for x, y in zip(self.x, self.y))
+                        writer.writerows((x, y, *band) for x, y, band in
+                                         zip(self.listX[-self.m:], self.listY[-self.m:], self.bands))
                     tkmb.showinfo("Save", "File " + outputFilename + " will be saved in " + directory, parent=self)
 
 
@@ -311,28 +354,29 @@ class DialogWin2(tk.Toplevel):
         Save plot variables to pickle file to be able to view the plot again in a different session.
         :return: none
         """
-        l = [self.x, self.y, self.choice, self.m, self.listX, self.listY, self.newlabel, self.newpos]
-        pickle.dump(l, open("{}_{}.bin".format(self.choice, str(datetime.date.today())), "wb"))
+        l = [self.x, self.y, self.choice, self.m, self.listX, self.listY, self.newlabel, self.newpos, self.bands]
+        pickle.dump(l, open(dataAccess.snapshotPath(self.choice, str(datetime.date.today())), "wb"))
 
     def _close(self):
         """
-        invalidates user's radio button choice, commits the database entries, closes the DB connection, and closes the current window.
+        invalidates user's radio button choice and closes the current window.
+        Saved entries are already committed by the writer.
         :return: None
         """
         self._controlVar.set("")
-        self.conn.commit()
-        self.conn.close()
+        self.visualObj.close()
         self.destroy()
 
 
 class DialogWin3(tk.Toplevel):
     """ a dialog window which lets the user choose a product from the 'Select Product' window.
     """
-    def __init__(self, master, productList):
+    def __init__(self, master, productList, productStats=None):
         """
         create a dialog window which is a top level window from the main window.
         :param master - a main window object.
         :param choiceList - an iterable that contains choice categories
+        :param productStats - optional dictionary of product ID: ProductStats used to sort and filter the list
         """
         super().__init__(master)
         self._master = master
@@ -347,10 +391,19 @@ class DialogWin3(tk.Toplevel):
         # Search bar with listbox filter
         # search bar reference: http://code.activestate.com/recipes/578860-setting-up-a-listbox-filter-in-tkinterpython-27/
         self.productList = productList
+        self.productStats = productStats
         self.search_var = tk.StringVar()
         self.search_var.trace("w", lambda name, index, mode: self.update_list())
         self.entry = tk.Entry(self, textvariable=self.search_var,width=13)
 
+        # sort and minimum active months filter, answered from the product statistics
+        self.sort_var = tk.StringVar()
+        self.sort_var.set(next(iter(SORT_OPTIONS)))
+        self.sort_var.trace("w", lambda name, index, mode: self.update_list())
+        self.minMonths_var = tk.StringVar()
+        self.minMonths_var.set(str(MIN_DATA_PTS + 1))
+        self.minMonths_var.trace("w", lambda name, index, mode: self.update_list())
+
         # product listbox
         self.LB = tk.Listbox(self.F1, yscrollcommand=S.set)
         self.LB.insert(tk.END, *productList)
@@ -365,6 +418,14 @@ class DialogWin3(tk.Toplevel):
         self.F2.grid(row=2)
         tk.Button(self.F2, text="OK", width=10, command=self._close).grid(padx=10, pady=10)
 
+        if productStats is not None:
+            self.F0 = tk.Frame(self)
+            tk.OptionMenu(self.F0, self.sort_var, *SORT_OPTIONS).grid(row=0, column=0)
+            tk.Label(self.F0, text="Min. months: ").grid(row=0, column=1)
+            tk.Spinbox(self.F0, from_=MIN_DATA_PTS + 1, to=999, width=4,
+                       textvariable=self.minMonths_var).grid(row=0, column=2)
+            self.F0.grid(row=3, padx=10, pady=3)
+
         self.update_list()
 
         self.grab_set()
@@ -382,8 +443,19 @@ class DialogWin3(tk.Toplevel):
         # clear listbox
         self.LB.delete(0, tk.END)
 
+        products = self.productList
+        if self.productStats is not None:
+            try:
+                minMonths = int(self.minMonths_var.get())
+            except ValueError:
+                minMonths = MIN_DATA_PTS + 1
+            products = [p for p in products if self.productStats[p].nonZeroMonths >= minMonths]
+            field, reverse = SORT_OPTIONS[self.sort_var.get()]
+            if field is not None:
+                products = sorted(products, key=lambda p: getattr(self.productStats[p], field), reverse=reverse)
+
         # fill listbox with matching search results
-        for item in self.productList:
+        for item in products:
             if search_term.lower() in str(item).lower():
                 self.LB.insert(tk.END, item)
 
@@ -9,8 +9,12 @@ final_visualization.py:
   It predicts the future quantity of the product based on given condition, and visualize it by plotting graph.
 """
 
-import sqlite3
+import dataAccess
+import forecastWriter
 import collections
+import json
+import sqlite3
+import bisect
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
@@ -19,30 +23,76 @@ from sklearn.linear_model import LinearRegression
 from sklearn.preprocessing import PolynomialFeatures
 from sklearn import metrics
 import threading
+from incrementalModel import IncrementalPolyModel
+import shipmentAggregation
 
 MIN_DATA_PTS = 10  # minimum number of data for modeling.
 MIN_R2 = 0.20      # minimum R2 value to predict the future data.
+BOOTSTRAP_SAMPLES = 2000            # number of residual bootstrap resamples for the prediction intervals.
+BAND_PERCENTILES = (10, 50, 90)     # P10/P50/P90 prediction interval of the forecast.
+NEGATIVE_FORECAST = 0.05            # quantity given for a negative prediction, shown on the graph as a short stub.
+
+# one row of the scenario table: the forecast of a product for the month 'horizon' months after the start month.
+SCENARIO_DTYPE = np.dtype([('productID', 'i8'), ('startYear', 'i2'), ('startMonth', 'i1'), ('horizon', 'i2'),
+                           ('quantity', 'f8'), ('p10', 'f8'), ('p50', 'f8'), ('p90', 'f8')])
+
+# per-product statistics gathered once at aggregation time.
+# firstActive and lastActive are (year, month) tuples of the first and last month with a positive quantity.
+ProductStats = collections.namedtuple('ProductStats', ['nonZeroMonths', 'firstActive', 'lastActive', 'totalVolume'])
+
+# the model of one product: the chosen degree with its metrics, the fitted model on the non zero months x, y,
+# and the residuals and pseudo-inverse of the design matrix on months divided by scale, used by the prediction intervals.
+ProductFit = collections.namedtuple('ProductFit', ['degree', 'maxR2', 'metricsDict', 'features', 'model',
+                                                   'x', 'y', 'yPred', 'residuals', 'scale', 'pinvX'])
+
+
+def clipForecast(forecastY):
+    """
+    replaces negative predicted quantities with NEGATIVE_FORECAST. forecastPlot and scenarios both use it,
+    so a forecast has the same value whether it is plotted, saved or part of a scenario table.
+    :param forecastY: an array of predicted quantities
+    :return: a new array
+    """
+    forecastY = np.asarray(forecastY, dtype=float)
+    return np.where(forecastY < 0, NEGATIVE_FORECAST, forecastY)
+
 
 class PlotOrder(object):
     """
     reads data from the product order database, and find the best model for each product by using polynomial regression.
     It predicts the future quantity of the product based on given condition, and visualize it by plotting graph.
     """
-    def __init__(self):
+    def __init__(self, incremental=False, memoryLimitMB=None, verbose=False):
         """
         reads data from the product order database, and create a dictionary for modelling.
+        :param incremental: True to keep an incremental model per product, so that new months of data
+                            are folded in without redoing the degree search (see addMonth).
+                            The models saved in Forecast.db by an earlier refreshCatalog are loaded.
+        :param memoryLimitMB: memory ceiling for the product data, for databases larger than RAM,
+                              e.g. dataAccess.getMemoryLimit(). The data is then aggregated in SQLite and
+                              streamed into a store that spills to disk (see shipmentAggregation.py).
+                              The peak RSS is kept in self.peakRSS.
+        :param verbose: True to print a summary of the memory-budgeted aggregation with its peak RSS
         """
+        self.incremental = incremental
+        self.memoryLimitMB = memoryLimitMB
+        self.verbose = verbose
+        self.incrementalModels = dict()     # key: product ID, value: IncrementalPolyModel
+        self._fitMetrics = dict()           # key: product ID, value: (maxR2, metricsDict) of the last full fit
+        self._fits = dict()                 # key: product ID, value: ProductFit, see getFit
         self._readData()
         self._createModelDict()
+        if self.incremental:
+            self.loadIncrementalModels()
 
 
     def _readData(self):
         """
-        reads data from the product order database.
+        finds the product order databases: Shipments.db, or its shards when the data was ingested in parallel.
+        They are read through the pooled read-only connections.
         :return: None
         """
-        self.conn = sqlite3.connect('Shipments.db')
-        self.cur = self.conn.cursor()
+        self.dbNames = dataAccess.shipmentsNames()
 
     def _createOrderDict(self):
         """
@@ -52,15 +102,16 @@ class PlotOrder(object):
         """
         self.productOrderDB_cal = dict()
         # create a dictionary whose key is the product ID and value is the default dictionary.
-        for record in self.cur.execute('''SELECT mkt_item_wid, cust_ship_date, quantity FROM Shipments'''):
+        for record in dataAccess.queryShipments(dataAccess.SELECT_SHIPMENTS, dbNames=self.dbNames,
+                                                legacySql=dataAccess.SELECT_LEGACY_SHIPMENTS):
             self.productOrderDB_cal[record[0]] = collections.defaultdict(dict)
 
         # insert the calendar year of each product order into the key of the default dictionary
         # and create another default dictionary.
-        for record in self.cur.execute('''SELECT mkt_item_wid, cust_ship_date, quantity FROM Shipments'''):
-            # skip 2050 year in the database
-            if not int(record[1].split('-')[0]) == 2050:
-                self.productOrderDB_cal[record[0]][int(record[1].split('-')[0])] = collections.defaultdict(float)
+        # sentinel (2050) dates are quarantined at ingest, or left out by SELECT_LEGACY_SHIPMENTS.
+        for record in dataAccess.queryShipments(dataAccess.SELECT_SHIPMENTS, dbNames=self.dbNames,
+                                                legacySql=dataAccess.SELECT_LEGACY_SHIPMENTS):
+            self.productOrderDB_cal[record[0]][int(record[1][0:4])] = collections.defaultdict(float)
 
         # fill every month into the default dictionary and initialize the quantity as zero by default.
         # because the database contains only positive value of product quantity.
@@ -70,9 +121,9 @@ class PlotOrder(object):
                     d[i] = 0
 
         # add all product quantities for each month.
-        for record in self.cur.execute('''SELECT mkt_item_wid, cust_ship_date, quantity FROM Shipments'''):
-            if not int(record[1].split('-')[0]) == 2050:
-                self.productOrderDB_cal[record[0]][int(record[1].split('-')[0])][int(record[1].split('-')[1])] += record[2]
+        for record in dataAccess.queryShipments(dataAccess.SELECT_SHIPMENTS, dbNames=self.dbNames,
+                                                legacySql=dataAccess.SELECT_LEGACY_SHIPMENTS):
+            self.productOrderDB_cal[record[0]][int(record[1][0:4])][int(record[1][5:7])] += record[2]
 
 
     def _createModelDict(self):
@@ -81,6 +132,10 @@ class PlotOrder(object):
         with key: product ID, value: a list of quantities in order of months including zero quantities.
         :return: None
         """
+        if self.memoryLimitMB is not None:
+            self._createBudgetedModelDict()
+            return
+
         self._createOrderDict()
         self.modelDict = collections.defaultdict(list)
 
@@ -90,25 +145,157 @@ class PlotOrder(object):
                     self.modelDict[k].append(q)
         #print(self.modelDict)
 
+        self._createProductStats()
+
 
-    def findAvaliableProducts(self):
+    def _createBudgetedModelDict(self):
+        """
+        create 'self.productOrderDB_cal' and 'self.modelDict' as views of a store that keeps at most
+        memoryLimitMB of product data in memory, and keep the peak RSS of the aggregation in self.peakRSS.
+        :return: None
+        """
+        shipmentAggregation.resetPeakRSS()
+        self.store = shipmentAggregation.aggregate(self.dbNames, self.memoryLimitMB)
+        self.productOrderDB_cal = self.store.calendars
+        self.modelDict = self.store.series
+        self._createProductStats()
+        self.peakRSS = shipmentAggregation.peakRSS()
+        if self.verbose:
+            print(shipmentAggregation.summary(self.store, self.memoryLimitMB, self.peakRSS))
+
+
+    def close(self):
+        """
+        deletes the spill file of the product data kept within memoryLimitMB. Nothing to do otherwise.
+        :return: None
+        """
+        if self.memoryLimitMB is not None:
+            self.store.close()
+
+
+    def _createProductStats(self):
+        """
+        create a dictionary called 'self.productStats' with key: product ID, value: ProductStats,
+        and an index of the products sorted by the number of non zero months so that eligibility
+        can be answered without scanning the quantity series again.
+        The statistics are read from the ProductStats table written at ingest (see shipmentsDB.createStatsTable),
+        or computed from the series for a Shipments.db built before that table existed.
+        :return: None
+        """
+        try:
+            rows = list(dataAccess.queryShipments(dataAccess.SELECT_PRODUCT_STATS, dbNames=self.dbNames))
+        except sqlite3.OperationalError:
+            rows = None     # no ProductStats table
+        if rows is None:
+            self.productStats = {k: self._seriesStats(k) for k in self.modelDict}
+        else:
+            self.productStats = dict()
+            for k, count, first, last, volume in rows:
+                self.productStats[k] = ProductStats(count, (int(first[0:4]), int(first[5:7])),
+                                                    (int(last[0:4]), int(last[5:7])), volume)
+            # products without any positive month have no row
+            for k in self.modelDict:
+                if k not in self.productStats:
+                    self.productStats[k] = ProductStats(0, None, None, 0.0)
+        self._indexProductStats()
+
+
+    def _seriesStats(self, productID):
+        """
+        computes the statistics of a product from its quantity series.
+        :param productID
+        :return: a ProductStats tuple
+        """
+        arr = np.asarray(self.modelDict[productID], dtype=float)
+        active = np.flatnonzero(arr > 0)
+        years = sorted(self.productOrderDB_cal[productID])
+        if len(active):
+            firstActive = (years[int(active[0]) // 12], int(active[0]) % 12 + 1)
+            lastActive = (years[int(active[-1]) // 12], int(active[-1]) % 12 + 1)
+        else:
+            firstActive = lastActive = None
+        return ProductStats(len(active), firstActive, lastActive, float(arr[arr > 0].sum()))
+
+
+    def _indexProductStats(self):
+        """
+        sorts the products by the number of non zero months for findAvaliableProducts.
+        :return: None
+        """
+        # products in ascending order of non zero months, with the counts kept alongside for bisect.
+        self._statsIndex = sorted(self.productStats, key=lambda k: self.productStats[k].nonZeroMonths)
+        self._statsCounts = [self.productStats[k].nonZeroMonths for k in self._statsIndex]
+
+
+    def getProductStats(self, productID):
+        """
+        returns the statistics of the given product.
+        :param productID
+        :return: a ProductStats tuple
+        """
+        return self.productStats[productID]
+
+
+    def findAvaliableProducts(self, minDataPts=MIN_DATA_PTS, sortBy=None, reverse=False):
         """
         a generator that generates product ID who has enough number of data to create a model.
         The list of products will appear in the listbox option.
+        :param minDataPts: products need more non zero months than this number
+        :param sortBy: optional ProductStats field name to order the products by
+        :param reverse: True to generate the products in descending order of sortBy
         :return: None
         """
-        for i, qList in self.modelDict.items():
-            arr = np.array(qList)
-            if len(arr[arr>0]) > MIN_DATA_PTS:
-                yield i
+        start = bisect.bisect_right(self._statsCounts, minDataPts)
+        products = self._statsIndex[start:]
+        if sortBy is not None:
+            products = sorted(products, key=lambda k: getattr(self.productStats[k], sortBy), reverse=reverse)
+        for i in products:
+            yield i
 
 
     def modeling(self, productID):
         """
-        find the best model for the given product ID by using polynomial regression.
+        find the best model for the given product ID by using polynomial regression, and make it the current model
+        (self.model, self.bestDegree, self.metricsDict, ... used by forecastPlot and getMae).
+        The product is fitted once (see getFit); in incremental mode a full fit also starts its incremental model.
         :param productID:
         :return maxR2:
         """
+        fit = self.getFit(productID)
+        if fit is None:
+            return None
+        if self.incremental and fit.model is not self.incrementalModels.get(productID):
+            self.incrementalModels[productID] = IncrementalPolyModel(fit.x, fit.y, fit.degree)
+            self._fitMetrics[productID] = (fit.maxR2, fit.metricsDict)
+
+        self.bestDegree = fit.degree
+        self.metricsDict = fit.metricsDict
+        self.polynomial_features = fit.features
+        self.model = fit.model
+        self.x_forPlot = fit.x
+        self.y_poly_pred = fit.yPred
+        return fit.maxR2
+
+
+    def getFit(self, productID):
+        """
+        returns the fit of the given product without changing the current model. A product is fitted on first use
+        and the fit is reused until addMonth changes its data, so forecastPlot and scenarios give the same forecasts.
+        :param productID:
+        :return: a ProductFit, or None if the product does not have enough data to create a model
+        """
+        if productID not in self._fits:
+            self._fits[productID] = self._fit(productID)
+        return self._fits[productID]
+
+
+    def _fit(self, productID):
+        """
+        fits the given product: the degree search and the refit on the full data, or the product's incremental model
+        when the new months are already folded into it and it has not drifted.
+        :param productID:
+        :return: a ProductFit, or None if the product does not have enough data to create a model
+        """
         monthList = []        # non zero quantity list
         quantityList = []     # corresponding month list
 
@@ -117,14 +304,26 @@ class PlotOrder(object):
                 monthList.append(i+1)
                 quantityList.append(self.modelDict[productID][i])
 
-        if len(monthList) > MIN_DATA_PTS:
-            # x, y is the original data-set for modeling.
-            x = np.array(monthList)
-            y = np.array(quantityList)
-
-            self.x_forPlot = x[:, np.newaxis]
-            y_forPlot = y[:, np.newaxis]
-
+        if len(monthList) <= MIN_DATA_PTS:
+            return None
+
+        # x, y is the original data-set for modeling.
+        x = np.array(monthList)
+        y = np.array(quantityList)
+
+        x_forPlot = x[:, np.newaxis]
+        y_forPlot = y[:, np.newaxis]
+
+        inc = self.incrementalModels.get(productID) if self.incremental else None
+        if inc is not None and not inc.needsRefit:
+            # the degree search and the refit are skipped.
+            maxR2, metricsDict = self._fitMetrics[productID]
+            bestDegree = inc.degree
+            polynomial_features = PolynomialFeatures(degree=bestDegree)
+            x_poly = polynomial_features.fit_transform(x_forPlot)
+            model = inc
+            scale = inc.scale
+        else:
             df = pd.DataFrame(data=np.concatenate((np.transpose(x[np.newaxis]), np.transpose(y[np.newaxis])), axis=1),
                               columns=['X', 'y'])
 
@@ -135,10 +334,11 @@ class PlotOrder(object):
             X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2)
 
             # Use multi-threading to gather the metrics data with the degrees 2~9
-            self.metricsDict = collections.defaultdict(float)
+            metricsDict = collections.defaultdict(float)
             threads = []
             for degree in range(2, 9):
-                t = threading.Thread(target=self.findBestDegree, args=(X_train, X_test, y_train, y_test, degree))
+                t = threading.Thread(target=self.findBestDegree,
+                                     args=(X_train, X_test, y_train, y_test, degree, metricsDict))
                 threads.append(t)
                 t.start()
 
@@ -146,30 +346,156 @@ class PlotOrder(object):
                 t.join()
 
             # find the best degree by finding maximum r2_test
-            self.bestDegree = 2
-            maxR2 = self.metricsDict[self.bestDegree][3]
-            for k, v in self.metricsDict.items():
+            bestDegree = 2
+            maxR2 = metricsDict[bestDegree][3]
+            for k, v in metricsDict.items():
                 if v[3] > maxR2:
-                    self.bestDegree = k
+                    bestDegree = k
                     maxR2 = v[3]
 
             # find a model with the best degree based on the original data-set for plotting.
-            self.polynomial_features = PolynomialFeatures(degree=self.bestDegree)
-            x_poly = self.polynomial_features.fit_transform(self.x_forPlot)
+            polynomial_features = PolynomialFeatures(degree=bestDegree)
+            x_poly = polynomial_features.fit_transform(x_forPlot)
 
-            self.model = LinearRegression()
-            self.model.fit(x_poly, y_forPlot)
+            model = LinearRegression()
+            model.fit(x_poly, y_forPlot)
+            scale = float(x.max())
 
-            self.y_poly_pred = self.model.predict(x_poly)
+        y_poly_pred = model.predict(x_poly)
 
-            return maxR2
+        # keep the residuals and a single factorization of the design matrix for the prediction intervals.
+        # powers of the month index up to x^8 are too far apart in size for pinv's cutoff, so the months are scaled
+        # to at most 1 first, like the power sums of IncrementalPolyModel.
+        return ProductFit(bestDegree, maxR2, metricsDict, polynomial_features, model, x_forPlot, y_forPlot,
+                          y_poly_pred, (y_forPlot - y_poly_pred).ravel(), scale,
+                          np.linalg.pinv(polynomial_features.transform(x_forPlot / scale)))
 
 
-    def findBestDegree(self, X_train, X_test, y_train, y_test, degreeNum=3):
+    def _poorModel(self, fit):
+        """
+        the unrealistic modeling case where R2 value is below MIN_R2 and mae is greater than 100.
+        :param fit: a ProductFit
+        :return: True if the forecasts of the fit are given as zero
+        """
+        return fit.maxR2 < MIN_R2 and fit.metricsDict[fit.degree][4] > 100
+
+
+    def addMonth(self, productID, year, month, quantity):
+        """
+        adds a shipped quantity of a product for a month after the data read from the database.
+        In incremental mode the observation is folded into the product's incremental model
+        instead of invalidating it; a full refit only happens in modeling when drift is detected.
+        :param productID, year, month, quantity
+        :return: True if the product's incremental model drifted and needs a full refit
+        """
+        calendar = self.productOrderDB_cal.setdefault(productID, collections.defaultdict(dict))
+        series = self.modelDict[productID]
+        if year not in calendar:
+            if calendar and year < max(calendar):
+                # a year before the latest one shifts every month index, so start over from the full data.
+                self.incrementalModels.pop(productID, None)
+            calendar[year] = collections.defaultdict(float)
+            for i in range(1, 13):
+                calendar[year][i] = 0
+            series[:] = [q for y, dic in sorted(calendar.items()) for m, q in sorted(dic.items())]
+
+        idx = sorted(calendar).index(year) * 12 + month - 1
+        old = series[idx]
+        calendar[year][month] += quantity
+        series[idx] = calendar[year][month]
+        # stored back so that a SeriesStore (memoryLimitMB) keeps the change when it spills the product.
+        self.productOrderDB_cal[productID] = calendar
+        self.modelDict[productID] = series
+        self._fits.pop(productID, None)
+
+        inc = self.incrementalModels.get(productID)
+        if inc is None:
+            # not modeled yet, the next modeling runs the full fit anyway.
+            return False
+        # months with zero quantity are not part of the modeling data.
+        if old != 0:
+            inc.update(idx + 1, old, weight=-1)
+        if series[idx] != 0:
+            inc.update(idx + 1, series[idx])
+        return inc.needsRefit
+
+
+    def refreshCatalog(self, year, month, quantities, refit=False):
+        """
+        adds one new month of shipments for the whole catalog, then updates the product statistics.
+        In incremental mode, the available products that have no incremental model yet get their full fit
+        once, and the models are saved to Forecast.db so that the next refresh, in any process, only folds in
+        its month. The new month has to be in Shipments.db by then, or the saved models no longer match
+        the data and are rebuilt.
+        :param year, month: the new month
+        :param quantities: a dictionary with key: product ID, value: shipped quantity of the month
+        :param refit: True to run the full degree search right away for the products that drifted
+        :return: a list of product IDs that need a full refit
+        """
+        drifted = [pid for pid, q in quantities.items() if self.addMonth(pid, year, month, q)]
+        # the new month is not in the ProductStats table, so the statistics of these products are recomputed
+        for pid in quantities:
+            self.productStats[pid] = self._seriesStats(pid)
+        self._indexProductStats()
+        if refit:
+            for pid in drifted:
+                self.modeling(pid)
+        if self.incremental:
+            missing = [pid for pid in self.findAvaliableProducts() if pid not in self.incrementalModels]
+            for pid in missing:
+                self.modeling(pid)
+            self.saveIncrementalModels(set(quantities) | set(missing))
+        return drifted
+
+
+    def loadIncrementalModels(self):
+        """
+        loads the incremental models saved in Forecast.db. A model is only used while it matches the
+        shipment data: the same first year and the same number of non zero months.
+        :return: number of models loaded
+        """
+        try:
+            rows = dataAccess.execute(dataAccess.FORECAST, dataAccess.SELECT_MODELS).fetchall()
+        except sqlite3.OperationalError:
+            return 0    # no Forecast.db, or one without saved models yet
+        for productID, firstYear, degree, scale, n, *state, maxR2, metricsJson in rows:
+            if productID not in self.modelDict:
+                continue
+            series = self.modelDict[productID]
+            if firstYear != min(self.productOrderDB_cal[productID]) or n != sum(1 for q in series if q != 0):
+                continue
+            self.incrementalModels[productID] = IncrementalPolyModel.fromState(degree, scale, n, *state)
+            metricsDict = collections.defaultdict(float, {int(k): tuple(v) for k, v in json.loads(metricsJson).items()})
+            self._fitMetrics[productID] = (maxR2, metricsDict)
+        return len(self.incrementalModels)
+
+
+    def saveIncrementalModels(self, productIDs=None):
+        """
+        saves the incremental models to the IncrementalModel table of Forecast.db through the writer queue.
+        :param productIDs: the products to save, every product with an incremental model by default
+        :return: None
+        """
+        if productIDs is None:
+            productIDs = self.incrementalModels
+        writer = forecastWriter.getWriter()
+        for pid in productIDs:
+            inc = self.incrementalModels.get(pid)
+            if inc is None:
+                continue
+            maxR2, metricsDict = self._fitMetrics[pid]
+            metricsJson = json.dumps({k: [float(m) for m in v] for k, v in metricsDict.items()})
+            writer.write((pid, min(self.productOrderDB_cal[pid]), *inc.state(), float(maxR2), metricsJson),
+                         dataAccess.REPLACE_MODEL)
+        writer.flush()
+
+
+    def findBestDegree(self, X_train, X_test, y_train, y_test, degreeNum=3, metricsDict=None):
         """
         stores the evaluating information of the polynomial regression model for a given degree number.
         uses random training data to avoid overfitting.
         :param X_train, X_test, y_train, y_test, degreeNum
+        :param metricsDict: the dictionary to store into, self.metricsDict by default
         :return: None
         """
 
@@ -197,7 +523,38 @@ class PlotOrder(object):
         r2_test = metrics.r2_score(y_test, y_test_predict)
         mae_test = metrics.mean_absolute_error(y_test, y_test_predict)
 
-        self.metricsDict[degreeNum] = (rmse_train, r2_train, rmse_test, r2_test, mae_test)
+        if metricsDict is None:
+            metricsDict = self.metricsDict
+        metricsDict[degreeNum] = (rmse_train, r2_train, rmse_test, r2_test, mae_test)
+
+    def predictionIntervals(self, fit, xFuture_poly, samples=BOOTSTRAP_SAMPLES):
+        """
+        computes the P10/P50/P90 prediction intervals of a fitted product at the given points by residual bootstrap.
+        Every resample refits the model on (fitted values + resampled residuals). Since least squares is linear in y,
+        all refits are one product of the stacked resampled residuals with the pseudo-inverse kept by the fit,
+        instead of a loop of refits.
+        :param fit: a ProductFit, see getFit
+        :param xFuture_poly: polynomial features of the months to predict, shape (m, degree + 1)
+        :param samples: number of bootstrap resamples
+        :return: an array of shape (m, 3) with the P10, P50 and P90 quantities of each month
+        """
+        n = len(fit.residuals)
+        dof = max(n - fit.pinvX.shape[0], 1)
+        # centered residuals, inflated to account for the degrees of freedom used by the fit
+        res = (fit.residuals - fit.residuals.mean()) * np.sqrt(n / dof)
+
+        # (m, n) map from a perturbation of the training y to the change of the refitted prediction,
+        # with the features of the months to predict on the same scale as the pseudo-inverse
+        xFuture_poly = np.asarray(xFuture_poly, dtype=float)
+        hat = (xFuture_poly / fit.scale ** np.arange(xFuture_poly.shape[1])).dot(fit.pinvX)
+        pointY = fit.model.predict(xFuture_poly)
+
+        fitNoise = res[np.random.randint(0, n, size=(n, samples))]          # (n, samples) stacked right-hand sides
+        newNoise = res[np.random.randint(0, n, size=(hat.shape[0], samples))]
+        simulated = pointY + hat.dot(fitNoise) + newNoise                    # (m, samples)
+
+        return np.percentile(simulated, BAND_PERCENTILES, axis=1).T
+
 
     def getMae(self):
         """
@@ -217,7 +574,8 @@ class PlotOrder(object):
         elif m == 1: m = 3      # One quarter choice
         elif m == 2: m = 12     # One year choice
 
-        maxR2 = self.modeling(productID)
+        self.modeling(productID)    # the current model, for getMae after the forecast
+        fit = self.getFit(productID)
         # find the index of the start month.
         currX = (startYear - sorted(self.productOrderDB_cal[productID].keys())[0])*12+startMon
 
@@ -229,27 +587,27 @@ class PlotOrder(object):
         currX_plot = self.polynomial_features.fit_transform(currX_forPlot)
 
         # predicted y values from the model
-        forecastY = self.model.predict(currX_plot)
+        forecastY = clipForecast(self.model.predict(currX_plot))
+        bands = np.clip(self.predictionIntervals(fit, currX_plot), 0, None)
         xticks1 = list(range(1, len(self.modelDict[productID]) + 1))
+        # history followed by the forecast, copied so that repeated forecasts do not change modelDict
+        listY = list(self.modelDict[productID])
 
         for f in forecastY:
-            if f[0] < 0:
-                #print("The quantity value is negative")
-                f[0] = 0.05     # to show the zero value on the graph as a short stub
-
             # for the unrealistic modeling case where R2 value is negative and mae is greater than 100,
             # set the result as zero.
-            if maxR2 < MIN_R2 and self.getMae() > 100:
-                self.modelDict[productID].append(0)
-                #print("R2 value of the model is", maxR2)
+            if self._poorModel(fit):
+                bands[:] = 0
+                listY.append(0)
+                #print("R2 value of the model is", fit.maxR2)
                 #print("MAE value of the model is", self.getMae())
-            else: self.modelDict[productID].append(f[0])
+            else: listY.append(f[0])
 
         # x axis for the graph
         xticks1.extend(monForPredictoin)
 
         # Bar chart
-        barList=plt.bar(xticks1, self.modelDict[productID])
+        barList=plt.bar(xticks1, listY)
         for i in range(1, m+1):
             barList[-1*i].set_color('r')    # for the forecast data, bar color is red
 
@@ -291,14 +649,79 @@ class PlotOrder(object):
 
         # plot the model graph
         plt.plot(self.x_forPlot, self.y_poly_pred, color='m')
+        self._plotBands(monForPredictoin, bands)
 
-        return self.x_forPlot, self.y_poly_pred, m, xticks1, self.modelDict[productID], newlabel, newpos
+        return self.x_forPlot, self.y_poly_pred, m, xticks1, listY, newlabel, newpos, bands
 
 
-    def savedForecastPlot(self, x, y, m, productID, listX, listY, newlabel, newpos):
+    def _plotBands(self, months, bands):
+        """
+        draws the P10~P90 prediction interval of every forecast month as an error bar with a P50 marker.
+        :param months: x positions of the forecast bars
+        :param bands: an array of shape (m, 3) with the P10, P50 and P90 quantities
+        :return: None
+        """
+        bands = np.asarray(bands)
+        plt.errorbar(months, bands[:, 1], yerr=[bands[:, 1] - bands[:, 0], bands[:, 2] - bands[:, 1]],
+                     fmt='_', color='k', ecolor='k', capsize=3)
+
+
+    def scenarios(self, starts, horizons=range(1, 13), productIDs=None, bands=False):
+        """
+        forecasts every product for every start month and every horizon without plotting or changing modelDict
+        or the current model. Each product is fitted once (see getFit), so the quantities are the same as those of
+        forecastPlot, and all of its (start, horizon) months are predicted in one evaluation.
+        A forecastPlot of m months from a start month is the rows of horizons 1~m of that start.
+        Quantities are the same as forecastPlot's: negative predictions become NEGATIVE_FORECAST (see clipForecast),
+        negative band values 0, and poor models (R2 < MIN_R2, MAE > 100) give 0.
+        :param starts: iterable of (startYear, startMonth)
+        :param horizons: iterable of the number of months after the start month to forecast
+        :param productIDs: the products to forecast, every available product by default
+        :param bands: True to add the P10/P50/P90 prediction intervals, NaN otherwise
+        :return: a numpy structured array of SCENARIO_DTYPE, one row per product, start and horizon
+        """
+        if productIDs is None:
+            productIDs = list(self.findAvaliableProducts())
+        starts = np.asarray(list(starts), dtype=int).reshape(-1, 2)
+        horizons = np.asarray(sorted(set(horizons)), dtype=int)
+
+        tables = []
+        for productID in productIDs:
+            fit = self.getFit(productID)
+            if fit is None:
+                continue    # not enough data to create a model
+            firstYear = sorted(self.productOrderDB_cal[productID].keys())[0]
+            currX = (starts[:, 0] - firstYear) * 12 + starts[:, 1]
+            months = (currX[:, np.newaxis] + horizons).ravel()
+
+            # neighbouring start months share most of their target months, so each month is predicted once.
+            uniqueMonths, inverse = np.unique(months, return_inverse=True)
+            x_poly = fit.features.fit_transform(uniqueMonths[:, np.newaxis].astype(float))
+
+            table = np.zeros(len(months), dtype=SCENARIO_DTYPE)
+            table['productID'] = productID
+            table['startYear'] = np.repeat(starts[:, 0], len(horizons))
+            table['startMonth'] = np.repeat(starts[:, 1], len(horizons))
+            table['horizon'] = np.tile(horizons, len(starts))
+            poorModel = self._poorModel(fit)
+            if not poorModel:
+                table['quantity'] = clipForecast(fit.model.predict(x_poly).ravel())[inverse]
+            if bands:
+                if not poorModel:
+                    intervals = np.clip(self.predictionIntervals(fit, x_poly), 0, None)[inverse]
+                    table['p10'], table['p50'], table['p90'] = intervals.T
+            else:
+                table['p10'] = table['p50'] = table['p90'] = np.nan
+            tables.append(table)
+
+        return np.concatenate(tables) if tables else np.zeros(0, dtype=SCENARIO_DTYPE)
+
+
+    def savedForecastPlot(self, x, y, m, productID, listX, listY, newlabel, newpos, bands=None):
         """
         plots the graph from the saved data when user clicks the listbox.
         :param x, y, m, productID, listX, listY, newlabel, newpos
+        :param bands: the saved prediction intervals, None for forecasts saved without them
         :return: None
         """
         barList = plt.bar(listX, listY)
@@ -329,6 +752,8 @@ class PlotOrder(object):
         ax2.set_xlim(ax1.get_xlim())
 
         plt.plot(x, y, color='m')
+        if bands is not None:
+            self._plotBands(listX[-m:], bands)
 
 
 
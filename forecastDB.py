@@ -6,9 +6,14 @@ Heather Koo
 CIS41B Final project
 forecastDB.py:
 - creates new database called "Forecast.db" to store predicted data.
+- the Forecast table keeps one summary row per saved forecast, ForecastSeries keeps its forecast months.
 """
 
 import sqlite3
+import dataAccess
+
+# prediction interval columns added after the first release of the Forecast table.
+BAND_COLUMNS = ('p10', 'p50', 'p90')
 
 class forecastDB(object):
     """ creates new database called "Forecast.db" to store predicted data.
@@ -17,11 +22,14 @@ class forecastDB(object):
         """ creates new database called "Forecast.db" to store predicted data.
         """
         try:
-            self.conn = sqlite3.connect('Forecast.db')
+            self.conn = dataAccess.connect(dataAccess.FORECAST)
             self.cur = self.conn.cursor()
+            # lets forecastRetention give the pages of purged rows back to the file system a few at a time.
+            self.cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
             self._createTable()
 
             self.conn.commit()
+            self.conn.execute("VACUUM")     # applies auto_vacuum to an existing file
             self.conn.close()
         except sqlite3.DatabaseError as e:
             print("Database Error: ", e)
@@ -30,13 +38,129 @@ class forecastDB(object):
         """ creates a new table called Forecast that contains predicted data information.
         """
         self.cur.execute("DROP TABLE IF EXISTS Forecast")
-        self.cur.execute('''CREATE TABLE Forecast (
-                                id INTEGER NOT NULL PRIMARY KEY,
-                                productID INTEGER,
-                                forecastRun DATE,
-                                period TEXT,
-                                expirationDate DATE,
-                                quantity REAL,
-                                accuracy REAL)''')
-
-forecastDB()
\ No newline at end of file
+        createForecastTable(self.cur)
+        self.cur.execute("DROP TABLE IF EXISTS ForecastSeries")
+        createSeriesTable(self.cur)
+        self.cur.execute("DROP TABLE IF EXISTS IncrementalModel")
+        createModelTable(self.cur)
+
+
+def createForecastTable(cur, schema='main'):
+    """ creates the Forecast table, in the forecast database or in an attached archive (see forecastRetention.py).
+    ids are AUTOINCREMENT, so the id of a purged forecast is never given to a new one and stays unique
+    in the archives.
+    :param cur: a cursor of the forecast database
+    :param schema: 'main' or the name of an attached database
+    :return: None
+    """
+    cur.execute('''CREATE TABLE IF NOT EXISTS {}.Forecast (
+                        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+                        productID INTEGER,
+                        forecastRun DATE,
+                        period TEXT,
+                        expirationDate DATE,
+                        quantity REAL,
+                        accuracy REAL,
+                        p10 REAL,
+                        p50 REAL,
+                        p90 REAL)'''.format(schema))
+    createIndexes(cur, schema)
+
+
+def createIndexes(cur, schema='main'):
+    """ creates the index on expirationDate used by the live forecast list and by the retention purge.
+    :param cur: a cursor of the forecast database
+    :param schema: 'main' or the name of an attached database
+    :return: None
+    """
+    cur.execute("CREATE INDEX IF NOT EXISTS {}.idx_forecast_expiration ON Forecast (expirationDate)".format(schema))
+
+
+def createSeriesTable(cur, schema='main'):
+    """ creates the ForecastSeries table that keeps every forecast month of a saved forecast,
+    with key: product ID, forecast run date and forecast month (YYYY-MM).
+    :param cur: a cursor of the forecast database
+    :param schema: 'main' or the name of an attached database
+    :return: None
+    """
+    cur.execute('''CREATE TABLE IF NOT EXISTS {}.ForecastSeries (
+                        productID INTEGER,
+                        forecastRun DATE,
+                        month TEXT,
+                        quantity REAL,
+                        p10 REAL,
+                        p50 REAL,
+                        p90 REAL)'''.format(schema))
+    cur.execute("CREATE INDEX IF NOT EXISTS {}.idx_series_product ON ForecastSeries (productID, forecastRun, month)"
+                .format(schema))
+
+
+def createModelTable(cur):
+    """ creates the IncrementalModel table that keeps the incremental model of every product between runs
+    (see incrementalModel.py): the chosen degree, the sufficient statistics and drift state as packed arrays,
+    and the metrics of the last full degree search as JSON. firstYear and n tie a model to the shipment data
+    it was built from.
+    :param cur: a cursor of the forecast database
+    :return: None
+    """
+    cur.execute('''CREATE TABLE IF NOT EXISTS IncrementalModel (
+                        productID INTEGER NOT NULL PRIMARY KEY,
+                        firstYear INTEGER,
+                        degree INTEGER,
+                        scale REAL,
+                        n INTEGER,
+                        updates INTEGER,
+                        needsRefit INTEGER,
+                        powerSums BLOB,
+                        moments BLOB,
+                        stepErrors BLOB,
+                        maxR2 REAL,
+                        metrics TEXT)''')
+
+
+def upgradeTable(cur):
+    """ adds the columns and tables missing from a forecast database created by an older version, keeping its rows.
+    :param cur: a cursor of the forecast database
+    :return: None
+    """
+    createModelTable(cur)
+    if 'runningError' in [row[1] for row in cur.execute("PRAGMA table_info(IncrementalModel)")]:
+        # saved before the drift test kept a window of errors, see IncrementalPolyModel.fromState
+        cur.execute("ALTER TABLE IncrementalModel RENAME COLUMN runningError TO stepErrors")
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(Forecast)")]
+    if not columns:
+        return
+    for name in BAND_COLUMNS:
+        if name not in columns:
+            cur.execute("ALTER TABLE Forecast ADD COLUMN {} REAL".format(name))
+    _upgradeIds(cur)
+    createIndexes(cur)
+    createSeriesTable(cur)
+
+
+def _upgradeIds(cur):
+    """ rebuilds a Forecast table created without AUTOINCREMENT, keeping its rows and ids,
+    so that ids of purged forecasts are not reused. Runs once, in its own transaction.
+    :param cur: a cursor of the forecast database
+    :return: None
+    """
+    selectSql = "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'Forecast'"
+    if 'AUTOINCREMENT' in cur.execute(selectSql).fetchone()[0].upper():
+        return
+    if cur.connection.in_transaction:
+        cur.connection.commit()
+    cur.execute("BEGIN IMMEDIATE")
+    if 'AUTOINCREMENT' in cur.execute(selectSql).fetchone()[0].upper():
+        cur.execute("COMMIT")   # upgraded by another process meanwhile
+        return
+    cur.execute("ALTER TABLE Forecast RENAME TO ForecastOld")
+    cur.execute("DROP INDEX IF EXISTS idx_forecast_expiration")
+    createForecastTable(cur)
+    columns = ", ".join(row[1] for row in cur.execute("PRAGMA table_info(ForecastOld)"))
+    cur.execute("INSERT INTO Forecast ({0}) SELECT {0} FROM ForecastOld".format(columns))
+    cur.execute("DROP TABLE ForecastOld")
+    cur.execute("COMMIT")
+
+
+if __name__ == '__main__':
+    forecastDB()
\ No newline at end of file
@@ -0,0 +1,145 @@
+"""
+Mia Skinner
+Heather Koo
+CIS41B Final project
+forecastExport.py:
+- exports every saved forecast of every product from Forecast.db into one file for the ERP import:
+  one row per forecast month, with the summary of the forecast (period, expiration date, accuracy).
+  Forecasts saved before the forecast months were kept have a single row with an empty month
+  and the quantity and band of their summary.
+- rows are streamed from SQLite in fixed-size chunks, so memory use does not grow with the number of forecasts.
+- writes CSV (gzip compressed when the file name ends with .gz) or a typed, columnar .npz file.
+"""
+
+import csv
+import gzip
+import io
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+import numpy as np
+import dataAccess
+
+CHUNK_ROWS = 100000                 # rows fetched from SQLite and written at a time.
+WRITE_BUFFER = 4 * 1024 * 1024      # bytes buffered before the CSV is written to the file.
+GZIP_LEVEL = 1                      # fast compression; the export is dominated by compression time otherwise.
+
+# column name and numpy type of the export, in the order of SELECT_FORECAST_EXPORT
+EXPORT_COLUMNS = [('forecastID', 'i8'),
+                  ('productID', 'i8'),
+                  ('forecastRun', 'M8[D]'),
+                  ('period', 'U16'),
+                  ('expirationDate', 'M8[D]'),
+                  ('accuracy', 'f8'),
+                  ('month', 'M8[M]'),
+                  ('quantity', 'f8'),
+                  ('p10', 'f8'),
+                  ('p50', 'f8'),
+                  ('p90', 'f8')]
+
+
+def _chunks(cur, chunkRows=CHUNK_ROWS):
+    """
+    a generator that streams the rows of an executed query in lists of rows.
+    :param cur: a cursor of the export query
+    :param chunkRows: rows per chunk
+    :return: None
+    """
+    while True:
+        rows = cur.fetchmany(chunkRows)
+        if not rows:
+            break
+        yield rows
+
+
+def exportCSV(filename, sql=dataAccess.SELECT_FORECAST_EXPORT, columns=EXPORT_COLUMNS, chunkRows=CHUNK_ROWS):
+    """
+    writes the result of the export query to a CSV file with a header row.
+    The file is gzip compressed when its name ends with .gz.
+    :param filename: the output file name
+    :param sql: the export query, all saved forecasts with their months by default
+    :param columns: list of (name, numpy type) of the query's columns, for the header
+    :param chunkRows: rows fetched and written at a time
+    :return: number of rows written
+    """
+    if filename.endswith('.gz'):
+        raw = gzip.open(filename, 'wb', compresslevel=GZIP_LEVEL)
+    else:
+        raw = open(filename, 'wb')
+    count = 0
+    with io.TextIOWrapper(io.BufferedWriter(raw, WRITE_BUFFER), encoding='utf-8', newline='') as fh:
+        writer = csv.writer(fh)
+        cur = dataAccess.execute(dataAccess.FORECAST, sql)
+        writer.writerow([name for name, dtype in columns])
+        for rows in _chunks(cur, chunkRows):
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+
+def exportNPZ(filename, sql=dataAccess.SELECT_FORECAST_EXPORT, columns=EXPORT_COLUMNS, chunkRows=CHUNK_ROWS):
+    """
+    writes the result of the export query to a .npz file with one typed array per column,
+    readable with numpy.load. Each column is filled chunk by chunk into a memory-mapped .npy file
+    that is then copied into the archive, so the whole result is never held in memory.
+    Dates are stored as datetime64, missing months as NaT and missing prediction intervals as NaN.
+    :param filename: the output file name
+    :param sql: the export query, all saved forecasts with their months by default
+    :param columns: list of (name, numpy type) of the query's columns
+    :param chunkRows: rows fetched and written at a time
+    :return: number of rows written
+    """
+    conn = dataAccess.getConnection(dataAccess.FORECAST)
+    tmpDir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        # one read transaction, so that the count and the rows come from the same snapshot
+        # even while other processes are saving forecasts.
+        conn.execute('BEGIN')
+        total = conn.execute('SELECT COUNT(*) FROM ({})'.format(sql)).fetchone()[0]
+        arrays = [np.lib.format.open_memmap(os.path.join(tmpDir, name + '.npy'), mode='w+', dtype=dtype, shape=(total,))
+                  for name, dtype in columns]
+        count = 0
+        for rows in _chunks(conn.execute(sql), chunkRows):
+            for arr, values in zip(arrays, zip(*rows)):
+                arr[count:count + len(rows)] = np.array(values, dtype=arr.dtype)
+            count += len(rows)
+        conn.rollback()
+        for arr in arrays:
+            arr.flush()
+        del arrays
+
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for name, dtype in columns:
+                zf.write(os.path.join(tmpDir, name + '.npy'), arcname=name + '.npy')
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        shutil.rmtree(tmpDir)
+    return count
+
+
+def export(filename):
+    """
+    exports all saved forecasts with their months in the format given by the file name: .npz, .csv or .csv.gz.
+    :param filename: the output file name
+    :return: number of rows written
+    """
+    if filename.endswith('.npz'):
+        return exportNPZ(filename)
+    return exportCSV(filename)
+
+
+def main():
+    """
+    Export all saved forecasts to the file given on the command line.
+    """
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'forecasts.csv.gz'
+    print("Exporting forecasts...")
+    count = export(filename)
+    print("******** Exported", count, "forecast rows to", filename, "********")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""
+Mia Skinner
+Heather Koo
+CIS41B Final project
+forecastRetention.py:
+- keeps the live working set of Forecast.db small: expired forecasts are moved to yearly archive files
+  (Forecast_archive_<forecastRun year>.db) or deleted, together with their ForecastSeries rows and
+  their pickled plot snapshots.
+- the purge runs in bounded batches of short transactions, in a background thread of the GUI or from
+  the command line, and gives the freed pages back with incremental VACUUM.
+- a Forecast.db created before incremental VACUUM needs one full VACUUM first, which locks the whole file.
+  Only the command line (or forecastDB.py) does it; the background thread skips the purge until then.
+- reports the size and row counts of the forecast database, its archives and the snapshot files.
+  Usage: python forecastRetention.py [stats]
+"""
+
+import datetime
+import glob
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import dataAccess
+import forecastDB
+import forecastWriter
+
+RETENTION_DAYS = 0          # days a forecast is kept after its expiration date.
+BATCH_ROWS = 500            # Forecast rows archived and deleted per transaction.
+BATCH_PAUSE = 0.05          # seconds between batches, so that the writers of other processes get the lock.
+VACUUM_PAGES = 1000         # free pages returned to the file system per incremental VACUUM step.
+PURGE_INTERVAL = 6 * 3600   # seconds between two purges of the background thread.
+
+SNAPSHOT_NAME = re.compile(r'^(\d+)_(\d{4}-\d{2}-\d{2})\.bin$')
+
+SELECT_EXPIRED = '''SELECT id, productID, forecastRun FROM Forecast
+                    WHERE expirationDate <= ? ORDER BY forecastRun, id LIMIT ?'''
+# a saved forecast's series and snapshot are shared by the Forecast rows of the same product and run date,
+# so they go only once none of those rows is left.
+ORPHAN_KEY = '''NOT EXISTS (SELECT 1 FROM main.Forecast f
+                            WHERE f.productID = ForecastSeries.productID AND f.forecastRun = ForecastSeries.forecastRun)'''
+# with Forecast.db in WAL mode a transaction over the attached archive is atomic per file only, so a crash
+# between the two commits leaves rows in both files. The copies are written so that the retry skips them:
+# Forecast rows by id, and the series of a product and run date, which are archived together, by that key.
+ARCHIVE_FORECASTS = '''INSERT OR IGNORE INTO archive.Forecast SELECT * FROM main.Forecast
+                       WHERE id IN (SELECT id FROM temp.PurgeIds)'''
+ARCHIVE_SERIES = '''INSERT INTO archive.ForecastSeries SELECT * FROM main.ForecastSeries
+                    WHERE productID = ? AND forecastRun = ? AND ''' + ORPHAN_KEY + '''
+                    AND NOT EXISTS (SELECT 1 FROM archive.ForecastSeries a WHERE a.productID = ? AND a.forecastRun = ?)'''
+
+
+def archivePath(year):
+    """
+    returns the file path of the archive of the forecasts run in a year, next to Forecast.db.
+    :param year: the year of forecastRun, e.g. '2026'
+    :return: the file path
+    """
+    root, ext = os.path.splitext(dataAccess.getPath(dataAccess.FORECAST))
+    return '{}_archive_{}{}'.format(root, year, ext)
+
+
+def incrementalVacuumEnabled(conn):
+    """
+    tells whether a forecast database uses incremental auto_vacuum.
+    :param conn: a connection to the forecast database
+    :return: True if it does
+    """
+    return conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+
+def enableIncrementalVacuum(conn):
+    """
+    switches a forecast database created without auto_vacuum to incremental auto_vacuum.
+    This needs one full VACUUM, which locks the file for every other reader and writer until it is done,
+    so it only runs once per file, from the command line.
+    :param conn: a write connection without an open transaction
+    :return: None
+    """
+    if not incrementalVacuumEnabled(conn):
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+
+
+def _attachArchive(conn, year, attached):
+    """
+    attaches the archive of a year as 'archive', creating its tables with the schema of Forecast.db on first use.
+    Only one archive is attached at a time.
+    :param conn: the purge connection, outside of a transaction
+    :param year: the year of forecastRun
+    :param attached: the year attached so far, or None
+    :return: the attached year
+    """
+    if attached == year:
+        return year
+    if attached is not None:
+        conn.execute('DETACH DATABASE archive')
+    conn.execute('ATTACH DATABASE ? AS archive', (archivePath(year),))
+    forecastDB.createForecastTable(conn.cursor(), 'archive')
+    forecastDB.createSeriesTable(conn.cursor(), 'archive')
+    return year
+
+
+def purgeExpired(archive=True, retentionDays=RETENTION_DAYS, batchRows=BATCH_ROWS, maxBatches=None,
+                 pause=BATCH_PAUSE, convert=True):
+    """
+    moves the forecasts that expired more than retentionDays ago to the archive of their forecastRun year
+    (or deletes them), with their series and snapshot files, then runs incremental VACUUM.
+    Every batch is one short BEGIN IMMEDIATE transaction of at most batchRows forecasts of one year.
+    :param archive: False to delete the expired forecasts without archiving them
+    :param retentionDays: days a forecast is kept after its expiration date
+    :param batchRows: Forecast rows per batch
+    :param maxBatches: stop after this many batches, None to purge everything expired
+    :param pause: seconds between batches
+    :param convert: True to switch a database without incremental auto_vacuum over first (see
+                    enableIncrementalVacuum), False to purge nothing and return None for such a database
+    :return: number of Forecast rows purged, None if the database was not converted
+    """
+    cutoff = str(datetime.date.today() - datetime.timedelta(days=retentionDays))
+    conn = forecastWriter.connect()
+    conn.isolation_level = None     # transactions are managed explicitly below
+    if not incrementalVacuumEnabled(conn):
+        if not convert:
+            conn.close()
+            return None
+        enableIncrementalVacuum(conn)
+    attached = None
+    purged = 0
+    batches = 0
+    try:
+        while maxBatches is None or batches < maxBatches:
+            rows = conn.execute(SELECT_EXPIRED, (cutoff, batchRows)).fetchall()
+            if not rows:
+                break
+            year = rows[0][2][0:4]
+            rows = [r for r in rows if r[2][0:4] == year]
+            ids = [(r[0],) for r in rows]
+            keys = sorted(set((r[1], r[2]) for r in rows))
+            if archive:
+                attached = _attachArchive(conn, year, attached)
+
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('CREATE TEMP TABLE IF NOT EXISTS PurgeIds (id INTEGER PRIMARY KEY)')
+                conn.execute('DELETE FROM temp.PurgeIds')
+                conn.executemany('INSERT INTO temp.PurgeIds VALUES (?)', ids)
+                if archive:
+                    conn.execute(ARCHIVE_FORECASTS)
+                conn.execute('DELETE FROM main.Forecast WHERE id IN (SELECT id FROM temp.PurgeIds)')
+                for key in keys:
+                    if archive:
+                        conn.execute(ARCHIVE_SERIES, key + key)
+                    conn.execute('DELETE FROM main.ForecastSeries '
+                                 'WHERE productID = ? AND forecastRun = ? AND ' + ORPHAN_KEY, key)
+                orphans = [key for key in keys if not conn.execute(
+                    'SELECT 1 FROM main.Forecast WHERE productID = ? AND forecastRun = ?', key).fetchone()]
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+            for productID, forecastRun in orphans:
+                try:
+                    os.remove(dataAccess.snapshotPath(productID, forecastRun))
+                except FileNotFoundError:
+                    pass
+            purged += len(ids)
+            batches += 1
+            conn.execute('PRAGMA incremental_vacuum({})'.format(VACUUM_PAGES))
+            time.sleep(pause)
+
+        # give back what is left of the free pages, a step at a time
+        while conn.execute('PRAGMA freelist_count').fetchone()[0] > 0:
+            conn.execute('PRAGMA incremental_vacuum({})'.format(VACUUM_PAGES))
+            time.sleep(pause)
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        if attached is not None:
+            conn.execute('DETACH DATABASE archive')
+        conn.close()
+    return purged
+
+
+def stats():
+    """
+    returns the size and row counts of the forecast database, its archives and the snapshot files.
+    :return: a dictionary
+    """
+    today = str(datetime.date.today())
+    path = dataAccess.getPath(dataAccess.FORECAST)
+    conn = dataAccess.getConnection(dataAccess.FORECAST)
+    pageSize = conn.execute('PRAGMA page_size').fetchone()[0]
+    result = {
+        'fileBytes': sum(os.path.getsize(path + s) for s in ('', '-wal') if os.path.exists(path + s)),
+        'pages': conn.execute('PRAGMA page_count').fetchone()[0],
+        'freeBytes': conn.execute('PRAGMA freelist_count').fetchone()[0] * pageSize,
+        'liveForecasts': conn.execute('SELECT COUNT(*) FROM Forecast WHERE expirationDate > ?', (today,)).fetchone()[0],
+        'expiredForecasts': conn.execute('SELECT COUNT(*) FROM Forecast WHERE expirationDate <= ?', (today,)).fetchone()[0],
+        'seriesRows': conn.execute('SELECT COUNT(*) FROM ForecastSeries').fetchone()[0],
+    }
+
+    archives = dict()
+    for archiveFile in sorted(glob.glob(archivePath('[0-9]' * 4))):
+        year = os.path.splitext(archiveFile)[0][-4:]
+        archiveConn = sqlite3.connect(dataAccess.readOnlyURI(archiveFile), uri=True)
+        archives[year] = {'fileBytes': os.path.getsize(archiveFile),
+                          'forecasts': archiveConn.execute('SELECT COUNT(*) FROM Forecast').fetchone()[0],
+                          'seriesRows': archiveConn.execute('SELECT COUNT(*) FROM ForecastSeries').fetchone()[0]}
+        archiveConn.close()
+    result['archives'] = archives
+
+    snapshotDir = dataAccess.getPath(dataAccess.SNAPSHOTS)
+    snapshots = [os.path.join(snapshotDir, f) for f in os.listdir(snapshotDir) if SNAPSHOT_NAME.match(f)]
+    result['snapshotFiles'] = len(snapshots)
+    result['snapshotBytes'] = sum(os.path.getsize(f) for f in snapshots)
+    return result
+
+
+class RetentionWorker(threading.Thread):
+    """ A background thread that purges expired forecasts at start and then every PURGE_INTERVAL seconds.
+    It never runs the full VACUUM of a database without incremental auto_vacuum, which would lock out
+    the other GUIs and batch writers; it skips the purge until the command line has converted the file.
+    """
+    def __init__(self, interval=PURGE_INTERVAL, **purgeOptions):
+        """
+        creates the thread; call start() to run it.
+        :param interval: seconds between two purges
+        :param purgeOptions: keyword arguments of purgeExpired
+        """
+        super().__init__(name='ForecastRetention', daemon=True)
+        self.interval = interval
+        self.purgeOptions = purgeOptions
+        self._stopEvent = threading.Event()
+
+    def run(self):
+        """
+        the thread: purges, then waits for the interval or stop().
+        :return: None
+        """
+        warned = False
+        while not self._stopEvent.is_set():
+            try:
+                if purgeExpired(convert=False, **self.purgeOptions) is None and not warned:
+                    print("Expired forecasts are kept until Forecast.db is converted: run python forecastRetention.py")
+                    warned = True
+            except sqlite3.DatabaseError as e:
+                print("Retention Error: ", e)
+            self._stopEvent.wait(self.interval)
+
+    def stop(self):
+        """
+        stops the thread after the current purge.
+        :return: None
+        """
+        self._stopEvent.set()
+
+
+_worker = None
+
+
+def startBackground(**options):
+    """
+    starts the background purge of this process once.
+    :param options: keyword arguments of RetentionWorker
+    :return: the RetentionWorker
+    """
+    global _worker
+    if _worker is None:
+        _worker = RetentionWorker(**options)
+        _worker.start()
+    return _worker
+
+
+def main():
+    """
+    Purge expired forecasts and print the statistics, or only print them with 'stats'.
+    """
+    if len(sys.argv) < 2 or sys.argv[1] != 'stats':
+        print("Purging expired forecasts...")
+        print("******** Purged", purgeExpired(), "forecasts ********")
+    for k, v in stats().items():
+        print(k, ":", v)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""
+Mia Skinner
+Heather Koo
+CIS41B Final project
+forecastWriter.py:
+- opens connections to "Forecast.db" in WAL mode so that readers never block the writer.
+- provides a single writer thread per process that batches Forecast inserts into short transactions,
+  so several GUIs and batch processes can save to the same file without "database is locked" errors.
+- the rows of one save can be queued as a group, which is committed in one transaction or not at all.
+"""
+
+import sqlite3
+import threading
+import queue
+import atexit
+import time
+import itertools
+import dataAccess
+from dataAccess import INSERT_FORECAST
+from forecastDB import upgradeTable
+
+BATCH_SIZE = 500        # maximum number of rows committed in one transaction.
+FLUSH_INTERVAL = 0.2    # seconds the writer waits for more rows before committing a partial batch.
+MAX_RETRIES = 5         # times a batch is retried when the database stays locked past the busy timeout.
+
+
+def connect():
+    """
+    opens a write connection to the forecast database with WAL journaling.
+    WAL lets any number of readers run alongside the single writer without blocking each other.
+    Forecast tables from older versions are upgraded in place.
+    :return: a sqlite3 connection
+    """
+    conn = dataAccess.connect(dataAccess.FORECAST)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    upgradeTable(conn.cursor())
+    conn.commit()
+    return conn
+
+
+def prepare():
+    """
+    switches the forecast database to WAL and upgrades its table, so that read-only connections
+    from dataAccess.getConnection can query it.
+    :return: None
+    """
+    connect().close()
+
+
+class _LockedError(sqlite3.OperationalError):
+    """ the database stayed locked past the busy timeout for every retry. """
+
+
+class ForecastWriter(object):
+    """ A background thread that owns the only write connection of the process.
+    Rows are queued by any thread and committed in batches of short BEGIN IMMEDIATE transactions.
+    Rows queued together with different insert statements are committed in the same transaction.
+    A group of rows (writeGroup) is never split across batches. When a batch fails, its groups are retried
+    one transaction each, so that only the failing group is lost, and the error goes to the thread that queued it.
+    """
+    def __init__(self, sql=INSERT_FORECAST, batchSize=BATCH_SIZE, flushInterval=FLUSH_INTERVAL):
+        """
+        starts the writer thread on the forecast database configured in dataAccess.
+        :param sql: the parameterized insert statement every queued row is written with
+        :param batchSize: maximum number of rows per transaction
+        :param flushInterval: seconds to wait for more rows before committing a partial batch
+        """
+        self.sql = sql
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self._queue = queue.Queue()     # (thread ident of the caller, list of (sql, row)), or None to stop
+        self._errors = dict()           # key: thread ident, value: the last database error of its rows
+        self._errorsLock = threading.Lock()
+        self._failure = None        # error that stopped the writer thread; every later write raises it
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='ForecastWriter', daemon=True)
+        self._thread.start()
+
+    def write(self, row, sql=None):
+        """
+        queues one row for insertion. Returns immediately.
+        :param row: a tuple of values for the insert statement
+        :param sql: another insert statement to write this row with, the writer's statement by default
+        :return: None
+        """
+        self.writeGroup([(sql, row)])
+
+    def writeGroup(self, rows):
+        """
+        queues rows that are committed together in one transaction, or not at all, e.g. the summary and
+        the series rows of one saved forecast. Returns immediately.
+        :param rows: an iterable of (insert statement or None for the writer's statement, tuple of values)
+        :return: None
+        """
+        if self._closed:
+            raise sqlite3.ProgrammingError("ForecastWriter is closed")
+        if self._failure is not None:
+            raise self._failure
+        group = [(sql or self.sql, row) for sql, row in rows]
+        if group:
+            self._queue.put((threading.get_ident(), group))
+
+    def writeMany(self, rows, sql=None):
+        """
+        queues several rows for insertion, e.g. from a batch forecasting job.
+        :param rows: an iterable of tuples of values for the insert statement
+        :param sql: another insert statement to write these rows with, the writer's statement by default
+        :return: None
+        """
+        for row in rows:
+            self.write(row, sql)
+
+    def flush(self):
+        """
+        blocks until every row queued so far has been committed or dropped by a failed writer.
+        raises the last database error of the rows queued by the calling thread, if any.
+        :return: None
+        """
+        self._queue.join()
+        if self._failure is not None:
+            raise self._failure
+        with self._errorsLock:
+            error = self._errors.pop(threading.get_ident(), None)
+        if error is not None:
+            raise error
+
+    def close(self):
+        """
+        commits the remaining rows and stops the writer thread.
+        :return: None
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        """
+        the writer thread: collects groups of rows into a batch until it is full or the flush interval passes,
+        then commits the batch in one transaction.
+        If the connection cannot be opened or the thread fails, the error is kept in self._failure
+        and the queued rows are dropped, so that flush and close never wait for a dead thread.
+        :return: None
+        """
+        conn = None
+        batch = []
+        stop = False
+        try:
+            conn = connect()
+            conn.isolation_level = None     # transactions are managed explicitly below
+            while not stop:
+                batch = []
+                rows = 0
+                item = self._queue.get()
+                deadline = time.monotonic() + self.flushInterval
+                while True:
+                    if item is None:
+                        stop = True
+                        self._queue.task_done()
+                    else:
+                        batch.append(item)
+                        rows += len(item[1])
+                    if stop or rows >= self.batchSize:
+                        break
+                    try:
+                        item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+
+                if batch:
+                    self._commit(conn, batch)
+                    for _ in batch:
+                        self._queue.task_done()
+                    batch = []
+        except Exception as e:
+            self._failure = e
+            for _ in batch:
+                self._queue.task_done()
+            # drop what is queued until close() queues the stop marker
+            while not stop:
+                stop = self._queue.get() is None
+                self._queue.task_done()
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _commit(self, conn, batch):
+        """
+        inserts one batch of groups in a single short transaction. If it fails for another reason than the lock,
+        every group is retried in its own transaction, so that the other groups of the batch are still saved.
+        Errors are kept for the threads that queued the failed groups.
+        :param conn: the writer connection
+        :param batch: a list of (thread ident, list of (sql, row tuple))
+        :return: None
+        """
+        error = self._transaction(conn, [item for _, group in batch for item in group])
+        if error is None:
+            return
+        if len(batch) > 1 and not isinstance(error, _LockedError):
+            for owner, group in batch:
+                groupError = self._transaction(conn, group)
+                if groupError is not None:
+                    self._setError(owner, groupError)
+            return
+        for owner, group in batch:
+            self._setError(owner, error)
+
+    def _transaction(self, conn, items):
+        """
+        inserts rows in a single short transaction, retrying while another process holds the lock.
+        :param conn: the writer connection
+        :param items: a list of (sql, row tuple)
+        :return: None when committed, else the database error; the transaction is rolled back
+        """
+        for attempt in range(MAX_RETRIES):
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                for sql, rows in itertools.groupby(items, key=lambda item: item[0]):
+                    conn.executemany(sql, [row for _, row in rows])
+                conn.execute('COMMIT')
+                return None
+            except sqlite3.OperationalError as e:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                if 'locked' not in str(e) and 'busy' not in str(e):
+                    return e
+                time.sleep(0.05 * 2 ** attempt)
+            except sqlite3.DatabaseError as e:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                return e
+        return _LockedError("database is locked, {} rows not saved".format(len(items)))
+
+    def _setError(self, owner, error):
+        """
+        keeps a database error for the thread whose rows failed, raised by its next flush.
+        :param owner: the thread ident of the thread that queued the rows
+        :param error: the database error
+        :return: None
+        """
+        with self._errorsLock:
+            self._errors[owner] = error
+
+
+
+_writers = dict()
+_writersLock = threading.Lock()
+
+
+def getWriter():
+    """
+    returns the shared writer of this process for the configured forecast database, creating it on first use.
+    :return: a ForecastWriter
+    """
+    path = dataAccess.getPath(dataAccess.FORECAST)
+    with _writersLock:
+        if path in _writers and _writers[path]._failure is not None:
+            # the old writer could not reach the database; try again with a new one
+            _writers.pop(path).close()
+        if path not in _writers:
+            _writers[path] = ForecastWriter()
+        return _writers[path]
+
+
+@atexit.register
+def _closeWriters():
+    """
+    commits any queued rows when the program exits.
+    :return: None
+    """
+    for writer in _writers.values():
+        writer.close()
@@ -0,0 +1,196 @@
+"""
+Mia Skinner
+Heather Koo
+CIS41B Final project
+incrementalModel.py:
+- keeps the sufficient statistics of the polynomial regression of one product, so that a new month of data
+  can be folded into the model without refitting from the full series or redoing the degree search.
+- detects when another candidate degree starts predicting the new data better than the chosen one,
+  which means the full degree search has to run again. The latest one-step-ahead errors of the degrees
+  are compared with a paired t-test, so that noise alone rarely sends a stable product back to the search.
+"""
+
+import numpy as np
+from scipy import stats
+
+MIN_DEGREE = 2          # candidate degrees are the same as the degree search of PlotOrder.modeling
+MAX_DEGREE = 8
+DEGREES = range(MIN_DEGREE, MAX_DEGREE + 1)
+DRIFT_WINDOW = 12           # number of latest one-step-ahead errors of every degree that drift is tested on.
+DRIFT_MIN_UPDATES = 6       # number of new observations needed before drift is checked.
+DRIFT_SIGNIFICANCE = 0.01   # chance of a false refit of a stable product, shared by the other degrees (Bonferroni).
+DRIFT_RATIO = 0.8           # and the other degree's summed squared error has to be below this ratio of the chosen one's.
+
+
+class IncrementalPolyModel(object):
+    """ Polynomial regression of quantity on month index that is updated one observation at a time.
+    For every candidate degree the Gram matrix X^T X is a Hankel matrix of the power sums sum(t^k),
+    so the power sums up to 2 * MAX_DEGREE and the moments sum(t^k * y) are the only state kept.
+    Months are scaled by a fixed factor to keep the power sums in range.
+    """
+    def __init__(self, x, y, degree):
+        """
+        creates the sufficient statistics from the existing data set.
+        :param x: month indices of the non zero quantities
+        :param y: the corresponding quantities
+        :param degree: the degree chosen by the full degree search
+        """
+        x = np.asarray(x, dtype=float).ravel()
+        y = np.asarray(y, dtype=float).ravel()
+        self.degree = degree
+        self.scale = float(x.max())
+        self.powerSums = np.zeros(2 * MAX_DEGREE + 1)
+        self.moments = np.zeros(MAX_DEGREE + 1)
+        self.n = 0
+        self.stepErrors = np.zeros((DRIFT_WINDOW, len(DEGREES)))   # squared one-step-ahead errors, one column per degree
+        self.updates = 0
+        self.needsRefit = False
+        self._coefCache = dict()
+
+        powers = (x / self.scale)[:, np.newaxis] ** np.arange(2 * MAX_DEGREE + 1)
+        self.powerSums += powers.sum(axis=0)
+        self.moments += powers[:, :MAX_DEGREE + 1].T.dot(y)
+        self.n = len(x)
+
+    @classmethod
+    def fromState(cls, degree, scale, n, updates, needsRefit, powerSums, moments, stepErrors):
+        """
+        recreates a model from the values returned by state, e.g. read back from the IncrementalModel table.
+        Drift errors saved in an older layout are dropped, and drift is checked again after DRIFT_MIN_UPDATES.
+        :param degree, scale, n, updates, needsRefit: the values of the attributes of the same name
+        :param powerSums, moments, stepErrors: the packed float64 arrays of state
+        :return: an IncrementalPolyModel
+        """
+        model = cls.__new__(cls)
+        model.degree = int(degree)
+        model.scale = float(scale)
+        model.n = int(n)
+        model.updates = int(updates)
+        model.needsRefit = bool(needsRefit)
+        model.powerSums = np.frombuffer(powerSums, dtype=np.float64).copy()
+        model.moments = np.frombuffer(moments, dtype=np.float64).copy()
+        stepErrors = np.frombuffer(stepErrors, dtype=np.float64)
+        if stepErrors.size == DRIFT_WINDOW * len(DEGREES):
+            model.stepErrors = stepErrors.reshape(DRIFT_WINDOW, len(DEGREES)).copy()
+        else:
+            model.stepErrors = np.zeros((DRIFT_WINDOW, len(DEGREES)))
+            model.updates = 0
+        model._coefCache = dict()
+        return model
+
+    def state(self):
+        """
+        returns the sufficient statistics and the drift state of the model, with the arrays packed as bytes.
+        :return: (degree, scale, n, updates, needsRefit, powerSums, moments, stepErrors)
+        """
+        return (self.degree, self.scale, self.n, self.updates, int(self.needsRefit),
+                self.powerSums.astype(np.float64).tobytes(), self.moments.astype(np.float64).tobytes(),
+                self.stepErrors.astype(np.float64).tobytes())
+
+    def coef(self, degree=None):
+        """
+        solves the normal equations of the given degree from the power sums.
+        :param degree: a candidate degree, the chosen degree by default
+        :return: coefficients of 1, t, ..., t^degree in the scaled month t
+        """
+        if degree is None:
+            degree = self.degree
+        if degree not in self._coefCache:
+            idx = np.arange(degree + 1)
+            gram = self.powerSums[idx[:, np.newaxis] + idx]
+            self._coefCache[degree] = np.linalg.lstsq(gram, self.moments[:degree + 1], rcond=None)[0]
+        return self._coefCache[degree]
+
+    def predictMonths(self, x, degree=None):
+        """
+        predicts the quantities of the given month indices.
+        :param x: month indices
+        :param degree: a candidate degree, the chosen degree by default
+        :return: an array of predicted quantities
+        """
+        c = self.coef(degree)
+        return np.polyval(c[::-1], np.asarray(x, dtype=float) / self.scale)
+
+    def predict(self, x_poly):
+        """
+        predicts from the PolynomialFeatures of the chosen degree, like LinearRegression.predict,
+        so that the model can replace PlotOrder.model.
+        :param x_poly: an array of shape (m, degree + 1) whose second column is the month index
+        :return: an array of shape (m, 1)
+        """
+        return self.predictMonths(np.asarray(x_poly)[:, 1])[:, np.newaxis]
+
+    def update(self, x, y, weight=1):
+        """
+        folds one observation into the model in O(MAX_DEGREE), after checking the one-step-ahead error
+        of every candidate degree for drift. A weight of -1 removes a previously folded observation.
+        :param x: month index of the observation
+        :param y: quantity of the observation
+        :param weight: 1 to add the observation, -1 to remove it
+        :return: True if the chosen degree is no longer the best and a full refit is needed
+        """
+        if weight > 0:
+            # the oldest row of the window is overwritten
+            self.stepErrors[self.updates % DRIFT_WINDOW] = [(y - self.predictMonths([x], d)[0]) ** 2 for d in DEGREES]
+            self.updates += 1
+
+        powers = (x / self.scale) ** np.arange(2 * MAX_DEGREE + 1)
+        self.powerSums += weight * powers
+        self.moments += weight * y * powers[:MAX_DEGREE + 1]
+        self.n += weight
+        self._coefCache.clear()
+
+        if weight > 0 and self.updates >= DRIFT_MIN_UPDATES:
+            self.needsRefit = self.needsRefit or self.drifted()
+        return self.needsRefit
+
+    def drifted(self):
+        """
+        tests whether another candidate degree predicts the latest observations better than the chosen degree.
+        For every other degree, the differences of the squared one-step-ahead errors over the window must have
+        a mean significantly above zero (one-sided paired t-test at DRIFT_SIGNIFICANCE divided by the number
+        of other degrees), and its summed squared error must be below DRIFT_RATIO of the chosen degree's.
+        :return: True if some other degree wins
+        """
+        errors = self.stepErrors[:min(self.updates, DRIFT_WINDOW)]
+        k = len(errors)
+        chosen = errors[:, DEGREES.index(self.degree)]
+        critical = stats.t.isf(DRIFT_SIGNIFICANCE / (len(DEGREES) - 1), k - 1)
+        for i, d in enumerate(DEGREES):
+            if d == self.degree or errors[:, i].sum() >= DRIFT_RATIO * chosen.sum():
+                continue
+            diff = chosen - errors[:, i]
+            sd = diff.std(ddof=1)
+            if sd == 0 or diff.mean() / (sd / np.sqrt(k)) > critical:
+                return True
+        return False
+
+
+def test(trials=400, months=48):
+    """
+    stable series must not be flagged: a product whose data really is linear plus noise keeps its chosen degree
+    through a year of monthly updates, while one whose trend breaks is flagged.
+    """
+    rng = np.random.RandomState(0)
+    flagged = 0
+    for trial in range(trials):
+        x = np.arange(1, months + 13, dtype=float)
+        y = 50 + 2 * x + rng.normal(0, 10, len(x))
+        model = IncrementalPolyModel(x[:months], y[:months], MIN_DEGREE)
+        for i in range(months, months + 12):
+            model.update(x[i], y[i])
+        flagged += model.needsRefit
+    print("stable series flagged for refit within 12 updates:", flagged, "of", trials)
+    assert flagged <= trials * 0.02
+
+    x = np.arange(1, months + 13, dtype=float)
+    y = np.where(x <= months, 50 + 2 * x, 50 + 2 * months + 12 * (x - months)) + rng.normal(0, 10, len(x))
+    model = IncrementalPolyModel(x[:months], y[:months], MIN_DEGREE)
+    for i in range(months, months + 12):
+        model.update(x[i], y[i])
+    print("series with a trend break flagged:", model.needsRefit)
+    assert model.needsRefit
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,318 @@
+"""
+Mia Skinner
+Heather Koo
+CIS41B Final project
+shipmentAggregation.py:
+- memory-budgeted aggregation of the shipment databases for PlotOrder, for histories larger than RAM.
+- the monthly sums are computed inside SQLite (which spills its sort to temporary files) and streamed
+  in fixed-size fetchmany chunks, one product at a time.
+- per-product monthly series are kept in memory up to the budget; the least recently used products
+  are spilled to a temporary SQLite file as packed arrays and loaded back when they are needed.
+- PlotOrder uses it when a memory ceiling is set (SHIPMENTS_MEMORY_MB, see dataAccess.py).
+  Run on its own to aggregate within a ceiling and report the peak RSS:
+  Usage: python shipmentAggregation.py [memory limit in MB]
+"""
+
+import collections
+import collections.abc
+import os
+import sqlite3
+import sys
+import tempfile
+import weakref
+import numpy as np
+import dataAccess
+
+CHUNK_ROWS = 50000                  # aggregated rows fetched from SQLite at a time.
+BYTES_PER_PRODUCT_YEAR = 1700       # estimated memory of one year of a product: a 12-month dict and 12 list items.
+
+AGGREGATE_SHIPMENTS = '''SELECT mkt_item_wid,
+                                CAST(substr(cust_ship_date, 1, 4) AS INTEGER) AS year,
+                                CAST(substr(cust_ship_date, 6, 2) AS INTEGER) AS month,
+                                SUM(quantity)
+                         FROM Shipments
+                         {}
+                         GROUP BY mkt_item_wid, year, month
+                         ORDER BY mkt_item_wid, year, month'''
+AGGREGATE_LEGACY_SHIPMENTS = AGGREGATE_SHIPMENTS.format(dataAccess.LEGACY_FILTER)     # see dataAccess.isLegacy
+AGGREGATE_SHIPMENTS = AGGREGATE_SHIPMENTS.format('')
+
+
+class SeriesStore(object):
+    """ The calendar dictionaries and monthly series of every product, within a memory budget.
+    calendars and series are dictionary-like views for PlotOrder.productOrderDB_cal and PlotOrder.modelDict.
+    Reading a product does not write it again: only products that were stored through put or the views
+    since they were last spilled are written to the spill file when they are evicted. So a product changed
+    in place has to be stored back (e.g. store.series[productID] = series) for the change to be kept.
+    """
+    def __init__(self, memoryLimitMB):
+        """
+        creates an empty store.
+        :param memoryLimitMB: memory budget of the products kept in memory
+        """
+        self.budget = memoryLimitMB * 1024 * 1024
+        self._mem = collections.OrderedDict()   # product ID: (calendar, series, dirty), least recently used first
+        self._bytes = 0
+        self._keys = set()
+        self._spilled = set()                   # products with a copy in the spill file
+        self._spill = None
+        self.spillWrites = 0
+        self.calendars = _StoreView(self, 0)
+        self.series = _StoreView(self, 1)
+
+    @property
+    def spilledProducts(self):
+        """ number of products that have been spilled to disk. """
+        return len(self._spilled)
+
+    def put(self, productID, calendar, series, dirty=True):
+        """
+        adds or replaces a product and evicts the least recently used products while over the budget.
+        :param productID
+        :param calendar: dictionary with key: year, value: dictionary(key: month, value: quantity)
+        :param series: list of quantities in order of months
+        :param dirty: False when the product is the same as its copy in the spill file
+        :return: None
+        """
+        if productID in self._mem:
+            calendarOld, seriesOld, dirtyOld = self._mem.pop(productID)
+            self._bytes -= self._size(calendarOld, seriesOld)
+        self._mem[productID] = (calendar, series, dirty)
+        self._keys.add(productID)
+        self._bytes += self._size(calendar, series)
+        while self._bytes > self.budget and len(self._mem) > 1:
+            self._evict()
+
+    def get(self, productID):
+        """
+        returns the calendar and the series of a product, loading it from the spill file if needed.
+        :param productID
+        :return: (calendar, series)
+        """
+        if productID in self._mem:
+            self._mem.move_to_end(productID)
+            return self._mem[productID][:2]
+        if productID not in self._keys:
+            raise KeyError(productID)
+        years, series = self._spill.execute('SELECT years, series FROM Spill WHERE productID = ?',
+                                            (productID,)).fetchone()
+        years = np.frombuffer(years, dtype=np.int64).tolist()
+        series = np.frombuffer(series, dtype=np.float64).tolist()
+        calendar = _calendar(years, series)
+        self.put(productID, calendar, series, dirty=False)
+        return calendar, series
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(sorted(self._keys))
+
+    def __contains__(self, productID):
+        return productID in self._keys
+
+    def close(self):
+        """
+        deletes the spill file. It is also deleted when the store is garbage collected or the program exits.
+        :return: None
+        """
+        if self._spill is not None:
+            self._finalizer()
+            self._spill = None
+
+    def _size(self, calendar, series):
+        """ estimated memory of one product. """
+        return BYTES_PER_PRODUCT_YEAR * max(len(calendar), 1)
+
+    def _evict(self):
+        """
+        drops the least recently used product from memory, writing it to the spill file as packed arrays
+        unless the spill file already has the same copy.
+        :return: None
+        """
+        productID, (calendar, series, dirty) = self._mem.popitem(last=False)
+        self._bytes -= self._size(calendar, series)
+        if not dirty and productID in self._spilled:
+            return
+        if self._spill is None:
+            fd, self._spillPath = tempfile.mkstemp(suffix='.db', prefix='spill_')
+            os.close(fd)
+            self._spill = sqlite3.connect(self._spillPath, isolation_level=None)
+            self._spill.execute('PRAGMA journal_mode=OFF')
+            self._spill.execute('PRAGMA synchronous=OFF')
+            self._spill.execute('CREATE TABLE Spill (productID INTEGER PRIMARY KEY, years BLOB, series BLOB)')
+            self._finalizer = weakref.finalize(self, _removeSpill, self._spill, self._spillPath)
+        self._spill.execute('INSERT OR REPLACE INTO Spill VALUES (?, ?, ?)',
+                            (productID, np.array(sorted(calendar), dtype=np.int64).tobytes(),
+                             np.array(series, dtype=np.float64).tobytes()))
+        self._spilled.add(productID)
+        self.spillWrites += 1
+
+
+class _StoreView(collections.abc.MutableMapping):
+    """ dictionary-like view of one part (0: calendar, 1: series) of the products of a SeriesStore. """
+    def __init__(self, store, part):
+        self._store = store
+        self._part = part
+
+    def __getitem__(self, productID):
+        return self._store.get(productID)[self._part]
+
+    def __setitem__(self, productID, value):
+        entry = list(self._store.get(productID)) if productID in self._store else [collections.defaultdict(dict), []]
+        entry[self._part] = value
+        self._store.put(productID, *entry)
+
+    def __delitem__(self, productID):
+        raise TypeError("products cannot be removed from a SeriesStore")
+
+    def __iter__(self):
+        return iter(self._store)
+
+    def __len__(self):
+        return len(self._store)
+
+    def __contains__(self, productID):
+        return productID in self._store
+
+
+def _removeSpill(conn, path):
+    """
+    closes and deletes a spill file.
+    :param conn: the connection to the spill file
+    :param path: the spill file path
+    :return: None
+    """
+    conn.close()
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _calendar(years, series):
+    """
+    rebuilds the calendar dictionary of a product from its years and its series of 12 months per year.
+    :param years: sorted list of years
+    :param series: list of quantities, 12 per year
+    :return: dictionary with key: year, value: dictionary(key: month, value: quantity)
+    """
+    calendar = collections.defaultdict(dict)
+    for i, year in enumerate(years):
+        calendar[year] = collections.defaultdict(float, zip(range(1, 13), series[i * 12:i * 12 + 12]))
+    return calendar
+
+
+def aggregate(dbNames, memoryLimitMB, chunkRows=CHUNK_ROWS):
+    """
+    streams the monthly quantity of every product from the shipment databases into a SeriesStore.
+    SQLite computes the monthly sums with a page cache of a quarter of the budget and temporary files
+    for its sort, and the store keeps the other three quarters, so neither side holds the raw rows.
+    :param dbNames: the shipment databases, see dataAccess.shipmentsNames
+    :param memoryLimitMB: memory budget in megabytes
+    :param chunkRows: aggregated rows fetched at a time
+    :return: a SeriesStore
+    """
+    store = SeriesStore(memoryLimitMB * 3 / 4)
+    for dbName in dbNames:
+        conn = dataAccess.connect(dbName, readOnly=True)
+        conn.execute('PRAGMA mmap_size=0')
+        conn.execute('PRAGMA cache_size=-{}'.format(max(memoryLimitMB * 1024 // 4, 1024)))
+        conn.execute('PRAGMA temp_store=FILE')
+        cur = conn.execute(AGGREGATE_LEGACY_SHIPMENTS if dataAccess.isLegacy(dbName) else AGGREGATE_SHIPMENTS)
+
+        # rows come ordered by product, so each product is complete when the next one starts.
+        productID, months = None, []
+        while True:
+            rows = cur.fetchmany(chunkRows)
+            for row in rows:
+                if row[0] != productID:
+                    if productID is not None:
+                        store.put(productID, *_productSeries(months))
+                    productID, months = row[0], []
+                months.append(row[1:])
+            if not rows:
+                break
+        if productID is not None:
+            store.put(productID, *_productSeries(months))
+        conn.close()
+    return store
+
+
+def _productSeries(months):
+    """
+    builds the calendar and the series of one product from its monthly sums.
+    Every year with shipments gets all 12 months, with zero for the months without shipments.
+    :param months: list of (year, month, quantity) in order
+    :return: (calendar, series)
+    """
+    years = sorted(set(m[0] for m in months))
+    series = [0] * (12 * len(years))
+    position = {year: i * 12 for i, year in enumerate(years)}
+    for year, month, quantity in months:
+        series[position[year] + month - 1] = quantity
+    return _calendar(years, series), series
+
+
+def summary(store, memoryLimitMB, peak):
+    """
+    returns a one-line report of a memory-budgeted aggregation.
+    :param store: the SeriesStore of the aggregation
+    :param memoryLimitMB: memory budget in megabytes
+    :param peak: peak RSS in megabytes, see peakRSS
+    :return: a string
+    """
+    return "Aggregated {} products within {} MB ({} spilled to disk), peak RSS: {} MB".format(
+        len(store), memoryLimitMB, store.spilledProducts, "unknown" if peak is None else round(peak, 1))
+
+
+def resetPeakRSS():
+    """
+    resets the peak resident set size of the process, so that peakRSS reports the peak of the next run only.
+    Only supported on Linux; elsewhere peakRSS reports the peak since the process started.
+    :return: None
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+    except OSError:
+        pass
+
+
+def peakRSS():
+    """
+    returns the peak resident set size of the process: VmHWM on Linux, which resetPeakRSS resets,
+    else the maximum RSS from getrusage. None where neither is available (Windows).
+    :return: peak RSS in megabytes
+    """
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def main():
+    """
+    Aggregates the shipment databases within the memory limit given on the command line,
+    or SHIPMENTS_MEMORY_MB, and prints the peak RSS.
+    """
+    memoryLimitMB = int(sys.argv[1]) if len(sys.argv) > 1 else dataAccess.getMemoryLimit()
+    if memoryLimitMB is None:
+        print("Usage: python shipmentAggregation.py [memory limit in MB], or set SHIPMENTS_MEMORY_MB")
+        raise SystemExit()
+    resetPeakRSS()
+    store = aggregate(dataAccess.shipmentsNames(), memoryLimitMB)
+    print(summary(store, memoryLimitMB, peakRSS()))
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
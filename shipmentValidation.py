@@ -0,0 +1,106 @@
+"""
+Mia Skinner
+Heather Koo
+CIS41B Final project
+shipmentValidation.py:
+- validates and normalizes the JSON shipment records once at ingest, column by column with pandas.
+- rows with missing fields, bad ids, unreadable or sentinel (2050) dates, or bad or negative quantities
+  are routed to the Quarantine table with a reason code instead of aborting the load,
+  so the read path never has to filter rows again.
+"""
+
+import json
+import collections
+import numpy as np
+import pandas as pd
+
+SENTINEL_YEAR = 2050    # placeholder year used in the source data for unknown ship dates.
+
+ID_COLUMNS = ['csd_date_wid', 'date_wid', 'customer_wid', 'mkt_item_wid']
+REQUIRED_COLUMNS = ID_COLUMNS + ['cust_ship_date', 'order_number', 'quantity']
+
+# reason codes, in the order they are checked. A row gets the first reason that applies.
+MALFORMED = 'malformed'                 # not a JSON object
+MISSING_FIELD = 'missing_field'
+BAD_ID = 'bad_id'
+BAD_DATE = 'bad_date'
+SENTINEL_DATE = 'sentinel_date'
+BAD_QUANTITY = 'bad_quantity'
+NEGATIVE_QUANTITY = 'negative_quantity'
+
+
+def createQuarantineTable(cur):
+    """
+    Creates the Quarantine table that keeps the rejected source records with their reason code.
+    :param cur: a cursor of a shipment database
+    :return: None
+    """
+    cur.execute("DROP TABLE IF EXISTS Quarantine")
+    cur.execute('''CREATE TABLE Quarantine (
+                        id INTEGER NOT NULL PRIMARY KEY,
+                        source TEXT,
+                        reason TEXT,
+                        record TEXT)''')
+
+
+def validateRecords(records, source=''):
+    """
+    Splits the JSON records of one file into normalized Shipments rows and quarantined rows.
+    Normalized rows have integer ids, the ship date as YYYY-MM-DD and the quantity as a float.
+    :param records: the list loaded from a JSON file
+    :param source: the file name, stored with the quarantined rows
+    :return: (list of INSERT_SHIPMENT tuples, list of Quarantine (source, reason, record) tuples,
+              Counter of reason code: number of rows, with 'ok' for the accepted rows)
+    """
+    quarantine = [(source, MALFORMED, json.dumps(d, default=str)) for d in records if not isinstance(d, dict)]
+    records = [d for d in records if isinstance(d, dict)]
+    df = pd.DataFrame.from_records(records, columns=REQUIRED_COLUMNS) if records else \
+        pd.DataFrame(columns=REQUIRED_COLUMNS)
+
+    reason = pd.Series(None, index=df.index, dtype=object)
+
+    def flag(mask, code):
+        """ sets the reason code of the rows in mask that have no reason yet. """
+        reason[mask & reason.isna()] = code
+
+    flag(df[REQUIRED_COLUMNS].isna().any(axis=1), MISSING_FIELD)
+
+    ids = df[ID_COLUMNS].apply(pd.to_numeric, errors='coerce')
+    flag((ids.isna() | (ids % 1 != 0)).any(axis=1), BAD_ID)
+
+    # only the calendar date counts: the time and offset are dropped without converting to UTC,
+    # which could move a late evening shipment into the next month.
+    dates = pd.to_datetime(df['cust_ship_date'].astype(str).str[:10], format='%Y-%m-%d', errors='coerce')
+    flag(dates.isna(), BAD_DATE)
+    flag(dates.dt.year == SENTINEL_YEAR, SENTINEL_DATE)
+
+    quantity = pd.to_numeric(df['quantity'], errors='coerce')
+    flag(quantity.isna() | ~np.isfinite(quantity.fillna(0)), BAD_QUANTITY)
+    flag(quantity < 0, NEGATIVE_QUANTITY)
+
+    bad = reason.notna().values
+    for i in np.flatnonzero(bad):
+        quarantine.append((source, reason.iat[i], json.dumps(records[i], default=str)))
+
+    good = ~bad
+    columns = [ids[c].values[good].astype(np.int64).tolist() for c in ID_COLUMNS]
+    columns.append(dates[good].dt.strftime('%Y-%m-%d').tolist())
+    columns.append(df['order_number'][good].astype(str).tolist())
+    columns.append(quantity.values[good].astype(float).tolist())
+    rows = list(zip(*columns))
+
+    report = collections.Counter(q[1] for q in quarantine)
+    report['ok'] = len(rows)
+    return rows, quarantine, report
+
+
+def printReport(report):
+    """
+    Prints the summary of a validation: accepted rows and quarantined rows per reason code.
+    :param report: a Counter from validateRecords
+    :return: None
+    """
+    print("  accepted rows:", report['ok'])
+    for code, count in sorted(report.items()):
+        if code != 'ok':
+            print("  quarantined ({}): {}".format(code, count))
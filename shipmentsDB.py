@@ -7,12 +7,30 @@ CIS41B Final project
 shipmentsDB.py:
 - creates new database called "Shipments.db" to store historical, shipment data.
 - Only run once if Shipments.db is missing, or to re-generate with a new JSON data file.
+- records are validated and normalized on the way in (see shipmentValidation.py); rejected records
+  go to the Quarantine table with a reason code and a summary is printed.
+- with a directory or glob of JSON files, ingests them in parallel worker processes into shard files
+  (Shipments_shard0.db, ...), each product in exactly one shard. PlotOrder reads across the shards.
+  Building Shipments.db from a single file removes the shard files.
+  Usage: python shipmentsDB.py ["exports/*.json" [number of shards]]
 """
 
 import json
 import sqlite3
+import os
+import sys
+import glob
+import collections
+import multiprocessing
+import pickle
+import re
+import shutil
+import tempfile
+import dataAccess
+import shipmentValidation
 
 DATA_FILE = 'data_201811191543.json'
+SHARDS = 8      # default number of shard files for the parallel ingest.
 
 class BuildShipmentDB(object):
     """ Uses the JSON file as input to build the database into a SQLite file.
@@ -23,12 +41,17 @@ class BuildShipmentDB(object):
         Uses the JSON file as input to build the database into a SQLite file.
         :param data - a JSON file name
         """
+        self.source = data
         self._readJSON(data)
+        # shard files are read instead of Shipments.db while they exist, so a rebuilt Shipments.db replaces them.
+        if removeShards(dataAccess.getPath(dataAccess.SHIPMENTS)):
+            print("Removed the shard files of the previous parallel ingest.")
         try:
-            self.conn = sqlite3.connect('Shipments.db')
+            self.conn = dataAccess.connect(dataAccess.SHIPMENTS)
             self.cur = self.conn.cursor()
             self._createTable()
             self._insertData()
+            self._createStatsTable()
 
             self.conn.commit()
             self.conn.close()
@@ -65,8 +88,38 @@ class BuildShipmentDB(object):
             "order_number" : "SO4660",
             "quantity" : 1.00
         """
-        self.cur.execute("DROP TABLE IF EXISTS Shipments")
-        self.cur.execute('''CREATE TABLE Shipments (
+        createTable(self.cur)
+
+
+    def _insertData(self):
+        """
+        Inserts the valid, normalized data into Shipments table from the dictionary
+        and the rejected records into Quarantine table, then prints the validation summary.
+        :return: None
+        """
+        rows, quarantine, self.report = shipmentValidation.validateRecords(self.dataDict, self.source)
+        self.cur.executemany(dataAccess.INSERT_SHIPMENT, rows)
+        self.cur.executemany(dataAccess.INSERT_QUARANTINE, quarantine)
+        shipmentValidation.printReport(self.report)
+
+
+    def _createStatsTable(self):
+        """
+        Creates the ProductStats table from the Shipments table.
+        :return: None
+        """
+        createStatsTable(self.cur)
+
+
+def createTable(cur):
+    """
+    Creates a main shipment table and the quarantine table using SQL commands.
+    cust_ship_date is stored as YYYY-MM-DD and quantity as a real number, normalized by shipmentValidation.
+    :param cur: a cursor of a shipment database
+    :return: None
+    """
+    cur.execute("DROP TABLE IF EXISTS Shipments")
+    cur.execute('''CREATE TABLE Shipments (
                                 id INTEGER NOT NULL PRIMARY KEY,
                                 csd_date_wid INTEGER,
                                 date_wid INTEGER,
@@ -74,40 +127,206 @@ class BuildShipmentDB(object):
                                 mkt_item_wid INTEGER,
                                 cust_ship_date DATE,
                                 order_number TEXT,
-                                quantity INTEGER)''')
+                                quantity REAL)''')
+    shipmentValidation.createQuarantineTable(cur)
 
 
-    def _insertData(self):
-        """
-        Inserts data into Shipments table from the dictionary.
-        :return: None
-        """
-        for d in self.dataDict:
-            self.cur.execute('''INSERT INTO Shipments
-                   (csd_date_wid, date_wid, customer_wid, mkt_item_wid, cust_ship_date, order_number, quantity)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)''', (d['csd_date_wid'],
-                                             d['date_wid'],
-                                             d['customer_wid'],
-                                             d['mkt_item_wid'],
-                                             d['cust_ship_date'],
-                                             d['order_number'],
-                                             d['quantity']))
+def createStatsTable(cur):
+    """
+    Creates the ProductStats table from the Shipments table, with one row per product holding
+    the number of months with shipments, the first and last active month (YYYY-MM) and the total volume.
+    PlotOrder reads it for product eligibility and the product picker instead of scanning every series;
+    the nonzero_months index returns the rows already in eligibility order (dataAccess.SELECT_PRODUCT_STATS).
+    :param cur: a cursor of a shipment database
+    :return: None
+    """
+    cur.execute("DROP TABLE IF EXISTS ProductStats")
+    cur.execute('''CREATE TABLE ProductStats (
+                            mkt_item_wid INTEGER NOT NULL PRIMARY KEY,
+                            nonzero_months INTEGER,
+                            first_active TEXT,
+                            last_active TEXT,
+                            total_volume REAL)''')
+    cur.execute('''INSERT INTO ProductStats
+               SELECT mkt_item_wid, COUNT(*), MIN(month), MAX(month), SUM(total)
+               FROM (SELECT mkt_item_wid, substr(cust_ship_date, 1, 7) AS month, SUM(quantity) AS total
+                     FROM Shipments
+                     GROUP BY mkt_item_wid, month
+                     HAVING SUM(quantity) > 0)
+               GROUP BY mkt_item_wid''')
+    cur.execute("CREATE INDEX idx_stats_months ON ProductStats (nonzero_months)")
+
+
+def shardOf(productID, shards):
+    """
+    Returns the shard of a product. All rows of a product go to the same shard.
+    :param productID: mkt_item_wid
+    :param shards: number of shards
+    :return: the shard number
+    """
+    return int(productID) % shards
+
+
+def stagingPath(shipmentsPath):
+    """
+    Returns the Shipments.db path under which new shards are built before they replace the current ones,
+    e.g. Shipments_staging.db for shard files Shipments_staging_shard3.db.
+    :param shipmentsPath: the Shipments.db path
+    :return: the staging path
+    """
+    root, ext = os.path.splitext(shipmentsPath)
+    return root + '_staging' + ext
+
+
+def shardFiles(shipmentsPath):
+    """
+    Returns the shard files of a Shipments.db path that exist on disk, with their -wal and -shm files.
+    :param shipmentsPath: the Shipments.db path
+    :return: a list of file paths
+    """
+    root, ext = os.path.splitext(shipmentsPath)
+    pattern = re.compile(re.escape(root + '_shard') + r'\d+' + re.escape(ext) + '(-wal|-shm)?$')
+    return [path for path in glob.glob(dataAccess.shardPath('*', shipmentsPath) + '*') if pattern.match(path)]
+
+
+def removeShards(shipmentsPath):
+    """
+    Deletes the shard files of a Shipments.db path.
+    :param shipmentsPath: the Shipments.db path
+    :return: number of files deleted
+    """
+    files = shardFiles(shipmentsPath)
+    for path in files:
+        os.remove(path)
+    return len(files)
+
+
+def _stageFile(args):
+    """
+    Worker: reads and validates one JSON file and writes its rows, split by shard, to staging files,
+    one per (file, shard), so that the file workers never wait for each other's locks.
+    :param args: (staging directory, file number, JSON file name, number of shards)
+    :return: (JSON file name, validation report)
+    """
+    stageDir, fileIndex, filename, shards = args
+    with open(filename, 'r') as fh:
+        records = json.load(fh)
+    rows, quarantine, report = shipmentValidation.validateRecords(records, filename)
+
+    buckets = collections.defaultdict(list)
+    for row in rows:
+        buckets[shardOf(row[3], shards)].append(row)
+    for i, bucket in buckets.items():
+        with open(os.path.join(stageDir, '{}_{}.pkl'.format(fileIndex, i)), 'wb') as fh:
+            pickle.dump(bucket, fh, pickle.HIGHEST_PROTOCOL)
+    if quarantine:
+        with open(os.path.join(stageDir, '{}_q.pkl'.format(fileIndex)), 'wb') as fh:
+            pickle.dump(quarantine, fh, pickle.HIGHEST_PROTOCOL)
+    return filename, report
+
+
+def _loadStaged(stageDir, name):
+    """
+    Returns the rows of a staging file, or no rows when the file has none for this shard.
+    :param stageDir: the staging directory
+    :param name: the staging file name
+    :return: a list of rows
+    """
+    path = os.path.join(stageDir, name)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as fh:
+        return pickle.load(fh)
+
+
+def _buildShard(args):
+    """
+    Worker: builds one shard file from the staged rows of every file in file order, in one transaction,
+    then creates its ProductStats table. Each shard has exactly one writer.
+    Quarantined rows of every file go to shard 0.
+    :param args: (Shipments.db path of the shard, staging directory, shard number, number of files)
+    :return: None
+    """
+    shipmentsPath, stageDir, i, fileCount = args
+    dataAccess.setPath(dataAccess.SHIPMENTS, shipmentsPath)
+    conn = dataAccess.connect(dataAccess.SHARD.format(i))
+    conn.execute('PRAGMA journal_mode=WAL')
+    cur = conn.cursor()
+    createTable(cur)
+    for f in range(fileCount):
+        cur.executemany(dataAccess.INSERT_SHIPMENT, _loadStaged(stageDir, '{}_{}.pkl'.format(f, i)))
+        if i == 0:
+            cur.executemany(dataAccess.INSERT_QUARANTINE, _loadStaged(stageDir, '{}_q.pkl'.format(f)))
+    createStatsTable(cur)
+    conn.commit()
+    conn.close()
+
+
+def ingestShards(source, shards=SHARDS, workers=None):
+    """
+    Loads every JSON file of a directory or glob pattern into shard files in parallel worker processes.
+    File workers validate and split their file by shard into staging files; shard workers then each build
+    one shard. The new shards are built under staging names and replace the existing shard files only
+    once every shard is complete, so a failed run leaves the previous data in place.
+    While shard files exist they are read instead of Shipments.db.
+    :param source: a directory of JSON files or a glob pattern
+    :param shards: number of shard files
+    :param workers: number of worker processes, the number of cores by default
+    :return: validation report of all files, a Counter of reason code: number of rows
+    """
+    if os.path.isdir(source):
+        files = sorted(glob.glob(os.path.join(source, '*.json')))
+    else:
+        files = sorted(glob.glob(source))
+    if not files:
+        print("No JSON files found for", source, ", exiting program.")
+        raise SystemExit()
+
+    shipmentsPath = dataAccess.getPath(dataAccess.SHIPMENTS)
+    staging = stagingPath(shipmentsPath)
+    removeShards(staging)       # left over from a failed run
+    stageDir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(shipmentsPath)))
+
+    total = collections.Counter()
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            for filename, report in pool.imap_unordered(_stageFile, [(stageDir, n, f, shards)
+                                                                     for n, f in enumerate(files)]):
+                print("  loaded", report['ok'], "of", sum(report.values()), "rows from", filename)
+                total.update(report)
+            pool.map(_buildShard, [(staging, stageDir, i, len(files)) for i in range(shards)])
+
+        dataAccess.closeAll()
+        removeShards(shipmentsPath)
+        for path in shardFiles(staging):
+            os.replace(path, path.replace(os.path.splitext(staging)[0], os.path.splitext(shipmentsPath)[0], 1))
+    except BaseException:
+        removeShards(staging)
+        raise
+    finally:
+        shutil.rmtree(stageDir)
+    return total
+
 
 def main():
     """
-    Store JSON file in SQLite DB
+    Store JSON file in SQLite DB, or a directory or glob of JSON files in shard files.
     """
+    if len(sys.argv) > 1:
+        shards = int(sys.argv[2]) if len(sys.argv) > 2 else SHARDS
+        print("Building", shards, "database shards...")
+        report = ingestShards(sys.argv[1], shards)
+        shipmentValidation.printReport(report)
+        print("******** Completed building", shards, "shards ********")
+        return
     print("Building database...")
     BuildShipmentDB(DATA_FILE)
     print("******** Completed building Shipment.db database ********")
 
 
 def test():
-    conn = sqlite3.connect('Shipments.db')
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM Shipments")
-    print(cur.fetchall())
-    conn.close()
+    print(dataAccess.execute(dataAccess.SHIPMENTS, "SELECT * FROM Shipments").fetchall())
 
-main()
-#test()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
+    #test()
\ No newline at end of file